@@ -11,11 +11,43 @@ PATH_TO_DICTIONARY_DOCS = "./boe_search/diccionario-espanol-txt/"
 DOCS_PER_YEAR_PATH = PATH_TO_ANN_PHOC_FILES + "n_docs_per_year.json"
 DOCS_YEARS_PATH = PATH_TO_ANN_PHOC_FILES + "files_years.json"
 SQLITE_DB_PATH = PATH_TO_ANN_PHOC_FILES + "full_dataset_db.db"
+ANNOY_IDXS_PATH = PATH_TO_ANN_PHOC_FILES + "annoy_idxs_v2/"
+IDXS_2_WORDS_PATH = PATH_TO_ANN_PHOC_FILES + "idxs_2_words_v2/"
+WORD_INDEXES_PATH = PATH_TO_ANN_PHOC_FILES + "word_indexes/"
 WORDS = PATH_TO_DICTIONARY_DOCS + "0_palabras_todas_no_conjugaciones.txt"
 STOP_WORDS = PATH_TO_DICTIONARY_DOCS + "spanish.txt"
 
-# Different folders from the Gaceta/BOE DB
-FOLDERS = fm.get_folders_from_folder(PATH_TO_OCR_DB)
+# Values loaded from the DB the first time they are used, so importing this module doesn't read anything
+LAZY_VALUES = {}
 
-# Get the dictionary with the number of documents for each year
-DOCS_YEAR = {int(k): int(v) for k,v in fm.load_json(DOCS_PER_YEAR_PATH).items()}
+def get_folders() -> list[str]:
+    """
+    Returns the different folders from the Gaceta/BOE DB, they are searched only the first time
+    """
+    if "FOLDERS" not in LAZY_VALUES:
+        LAZY_VALUES["FOLDERS"] = fm.get_folders_from_folder(PATH_TO_OCR_DB)
+    return LAZY_VALUES["FOLDERS"]
+
+def get_docs_year() -> dict:
+    """
+    Returns the dictionary with the number of documents for each year, it is loaded only the first time
+    """
+    if "DOCS_YEAR" not in LAZY_VALUES:
+        LAZY_VALUES["DOCS_YEAR"] = {int(k): int(v) for k,v in fm.load_json(DOCS_PER_YEAR_PATH).items()}
+    return LAZY_VALUES["DOCS_YEAR"]
+
+def warm_up():
+    """
+    Loads all the lazy values of this module, meant to be called when a server is started
+    """
+    get_folders()
+    get_docs_year()
+
+def __getattr__(name : str):
+    # common.FOLDERS and common.DOCS_YEAR are loaded on first use, but "from common import *" doesn't call this function,
+    # so the modules that import everything from common must use get_folders() and get_docs_year() instead
+    if name == "FOLDERS":
+        return get_folders()
+    if name == "DOCS_YEAR":
+        return get_docs_year()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
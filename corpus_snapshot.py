@@ -0,0 +1,152 @@
+import file_manager as fm
+from tqdm import tqdm
+import numpy as np
+import time as t
+import os
+
+# Columns of the snapshot saved as strings, the rest are numpy arrays
+STRING_COLUMNS = ["docs_path","docs_href","pages_name","sections_bbox","sections_text"]
+
+def create_corpus_snapshot(path_to_ocr_db : str, snapshot_path : str):
+    """
+    Converts all the JSON documents of the OCR DB into a columnar snapshot that can be memory-mapped
+    The snapshot has the following columns:
+       · docs_path, docs_href, docs_year -> the path (relative to the OCR DB), link and year of each document
+       · docs_page_start -> the position of the first page of each document, the pages of a document go until the first page of the next one
+       · pages_name, pages_section_start -> the name of each page and the position of its first section
+       · sections_bbox, sections_text, sections_similarity -> the bounding box, OCR text and similarity of each section
+
+    Parameters:
+        path_to_ocr_db : string
+            The folder with the JSON documents
+        snapshot_path : string
+            The folder where the snapshot is going to be saved
+    """
+    tI = t.time()
+    if not os.path.exists(snapshot_path):
+        os.makedirs(snapshot_path)
+    files = fm.filter_files(sorted(fm.get_filenames_from_folder(path_to_ocr_db)),"json")
+    # The string columns are written to disk as the documents are read
+    blobs = {column: open(f"{snapshot_path}/{column}.bin","wb") for column in STRING_COLUMNS}
+    offsets = {column: [0] for column in STRING_COLUMNS}
+    def add_string(column,string):
+        encoded = string.encode("utf-8")
+        blobs[column].write(encoded)
+        offsets[column].append(offsets[column][-1]+len(encoded))
+
+    docs_year = []
+    docs_page_start = [0]
+    pages_section_start = [0]
+    sections_similarity = []
+    for file in tqdm(files,'files'):
+        # The whole document is extracted before adding it, so a document that fails doesn't leave the columns with different lengths
+        try:
+            document = fm.read_document(file)
+            href = document.get('document_href','')
+            year = int(document['date'].split('/')[-1]) if 'date' in document else -1
+            pages = []
+            for page,elems in document['pages'].items():
+                pages.append((str(page),[(str(elem['bbox']),str(elem['ocr']),float(elem.get('similarity',np.nan))) for elem in elems]))
+        except Exception as e:
+            print()
+            print(f"{file}: {e}")
+            continue
+        add_string("docs_path",os.path.relpath(file,path_to_ocr_db))
+        add_string("docs_href",href)
+        docs_year.append(year)
+        for page,sections in pages:
+            add_string("pages_name",page)
+            for bbox,text,similarity in sections:
+                add_string("sections_bbox",bbox)
+                add_string("sections_text",text)
+                sections_similarity.append(similarity)
+            pages_section_start.append(pages_section_start[-1]+len(sections))
+        docs_page_start.append(docs_page_start[-1]+len(pages))
+
+    for column in STRING_COLUMNS:
+        blobs[column].close()
+        np.save(f"{snapshot_path}/{column}_offsets.npy",np.asarray(offsets[column],dtype=np.int64))
+    np.save(f"{snapshot_path}/docs_year.npy",np.asarray(docs_year,dtype=np.int16))
+    np.save(f"{snapshot_path}/docs_page_start.npy",np.asarray(docs_page_start,dtype=np.int64))
+    np.save(f"{snapshot_path}/pages_section_start.npy",np.asarray(pages_section_start,dtype=np.int64))
+    np.save(f"{snapshot_path}/sections_similarity.npy",np.asarray(sections_similarity,dtype=np.float32))
+    print(f"{len(docs_year)} documents saved to the snapshot in {t.time()-tI}")
+
+def load_corpus_snapshot(snapshot_path : str) -> dict:
+    """
+    Loads a snapshot created with create_corpus_snapshot, all the columns are memory-mapped
+
+    Parameters:
+        snapshot_path : string
+            The folder of the snapshot
+    Returns:
+        snapshot : dictionary
+            The columns of the snapshot, MappedStrings for the string columns and numpy arrays for the rest
+    """
+    snapshot = {column: fm.MappedStrings(f"{snapshot_path}/{column}") for column in STRING_COLUMNS}
+    for column in ["docs_year","docs_page_start","pages_section_start","sections_similarity"]:
+        snapshot[column] = np.load(f"{snapshot_path}/{column}.npy",mmap_mode='r')
+    return snapshot
+
+def get_n_documents(snapshot : dict) -> int:
+    """
+    Returns the number of documents of a snapshot
+    """
+    return len(snapshot['docs_year'])
+
+def get_document_sections(snapshot : dict, doc_idx : int) -> tuple[int,int]:
+    """
+    Returns the positions of the first and last (not included) sections of a document
+    """
+    first_page = snapshot['docs_page_start'][doc_idx]
+    last_page = snapshot['docs_page_start'][doc_idx+1]
+    return int(snapshot['pages_section_start'][first_page]),int(snapshot['pages_section_start'][last_page])
+
+def get_bbox_from_snapshot(snapshot : dict, doc_idx : int) -> list[list[str]]:
+    """
+    Get all texts from each page of a document of the snapshot, the same result as file_manager.get_bbox_from_JSON
+
+    Parameters:
+        snapshot : dictionary
+            The loaded snapshot
+        doc_idx : integer
+            The position of the document in the snapshot
+    Returns:
+        sections : list of lists of strings
+            A list containing all instances of page, bounding box, OCR text in the document
+    """
+    sections = []
+    for page in range(snapshot['docs_page_start'][doc_idx],snapshot['docs_page_start'][doc_idx+1]):
+        page_name = snapshot['pages_name'][page]
+        for sect in range(snapshot['pages_section_start'][page],snapshot['pages_section_start'][page+1]):
+            sections.append([page_name,snapshot['sections_bbox'][sect],snapshot['sections_text'][sect]])
+    return sections
+
+def iter_snapshot_documents(snapshot : dict):
+    """
+    Iterates over the documents of a snapshot
+
+    Yields:
+        doc_idx : integer
+            The position of the document in the snapshot
+        path : string
+            The path of the document, relative to the OCR DB
+        year : integer
+            The year of the document
+        href : string
+            The link to the original document
+    """
+    for doc_idx in range(get_n_documents(snapshot)):
+        yield doc_idx,snapshot['docs_path'][doc_idx],int(snapshot['docs_year'][doc_idx]),snapshot['docs_href'][doc_idx]
+
+def iter_snapshot_texts(snapshot : dict, doc_idx : int):
+    """
+    Iterates over the OCR text of each section of a document without copying nor decoding it
+
+    Yields:
+        text : memoryview
+            The UTF-8 bytes of the OCR text of the section
+    """
+    first,last = get_document_sections(snapshot,doc_idx)
+    for sect in range(first,last):
+        yield snapshot['sections_text'].get_bytes(sect)
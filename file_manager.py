@@ -1,9 +1,101 @@
+from collections import OrderedDict
+from multiprocessing import Pool
+import sqlite_manager as s
 from tqdm import tqdm
+import numpy as np
+import threading
 import time as t
 import pickle
 import json
 import os
 
+# orjson is used to parse the documents when it is installed, it is several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bounded cache of parsed documents, the key of each document is its path and modification time
+DOCUMENT_CACHE_SIZE = 256
+DOCUMENT_CACHE = OrderedDict()
+DOCUMENT_CACHE_LOCK = threading.Lock()
+
+def parse_json(content : bytes):
+    """
+    Parses the content of a JSON file with the fastest available backend
+
+    Parameters:
+        content : bytes
+            The content of the file
+    Returns:
+        object : Any
+            The parsed object
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def read_document(filename : str) -> dict:
+    """
+    Reads and parses a JSON document without using the cache, meant for jobs that go through the whole corpus once
+
+    Parameters:
+        filename : string
+            The path to the document
+    Returns:
+        document : dictionary
+            The parsed document
+    """
+    with open(filename,"rb") as doc_in:
+        return parse_json(doc_in.read())
+
+def load_document(filename : str) -> dict:
+    """
+    Returns the parsed JSON document, documents are kept in a bounded LRU cache and parsed again only if the file has changed
+    The returned document is shared with other callers, so it must not be modified
+
+    Parameters:
+        filename : string
+            The path to the document
+    Returns:
+        document : dictionary
+            The parsed document
+    """
+    key = (filename,os.stat(filename).st_mtime_ns)
+    with DOCUMENT_CACHE_LOCK:
+        if key in DOCUMENT_CACHE:
+            DOCUMENT_CACHE.move_to_end(key)
+            return DOCUMENT_CACHE[key]
+    document = read_document(filename)
+    with DOCUMENT_CACHE_LOCK:
+        DOCUMENT_CACHE[key] = document
+        while len(DOCUMENT_CACHE) > DOCUMENT_CACHE_SIZE:
+            DOCUMENT_CACHE.popitem(last=False)
+    return document
+
+def load_many(filenames : list[str], use_cache : bool = True) -> list[dict]:
+    """
+    Returns the parsed JSON documents of a list of files
+
+    Parameters:
+        filenames : list of strings
+            The paths to the documents
+        use_cache : bool
+            If the documents are to be taken from and kept in the cache
+    Returns:
+        documents : list of dictionaries
+            The parsed documents, in the same order as filenames
+    """
+    if use_cache:
+        return [load_document(filename) for filename in filenames]
+    return [read_document(filename) for filename in filenames]
+
+def get_document_href(filename : str) -> str:
+    """
+    Returns the link to the original document of a file
+    """
+    return load_document(filename)['document_href']
+
 def get_filenames_from_folder(folder : str) -> list[str]:
     """
     Recursive search for all the files in a given folder
@@ -24,6 +116,21 @@ def get_filenames_from_folder(folder : str) -> list[str]:
             file_list = file_list + get_filenames_from_folder(myitem_path)
     return file_list
 
+def filter_files(file_list : list[str], extension : str) -> list[str]:
+    """
+    Keeps only the files with a given extension
+
+    Parameters:
+        file_list : list of strings
+            A list with the path to each file
+        extension : string
+            The extension of the files to keep, without the dot
+    Returns:
+        filtered : list of strings
+            A list with the path to each file with the given extension
+    """
+    return [file for file in file_list if file.endswith(f".{extension}")]
+
 def get_folders_from_folder(folder : str) -> list[str]:
     """
     Search for all the folders in a given folder
@@ -53,7 +160,8 @@ def get_bbox_from_JSON(filename : str) -> list[list[str]]:
         sections : list of lists of strings
             A list containing all instances of page, bounding box, OCR text in the file
     """
-    json_data = json.load(open(filename))
+    # It is used to go through the whole corpus when building indexes, so the document cache is not used
+    json_data = read_document(filename)
     sections = []
     for page in json_data['pages'].keys():
         if json_data['pages'][page] != []:
@@ -72,7 +180,7 @@ def get_most_significant_bbox_from_JSON(filename : str) -> str:
         ocr : string
             The text of the most similar section
     """
-    json_data = json.load(open(filename))
+    json_data = load_document(filename)
     target_text = {}
     for page in json_data['pages'].keys():
         if json_data['pages'][page] != []:
@@ -91,7 +199,7 @@ def get_second_most_significant_bbox_from_JSON(filename : str) -> str:
         ocr : string
             The text of the second most similar section
     """
-    json_data = json.load(open(filename))
+    json_data = load_document(filename)
     target_text = {}
     second_best = None
     last_target = None
@@ -189,11 +297,96 @@ def load_json(filename,show_time=False):
         print(f"{t.time()-tI} to load file {os.path.basename(filename)}")
     return obj
 
-def get_n_files_per_year(folder):
+def get_document_metadata(args : tuple[str,str]) -> tuple | None:
+    """
+    Reads the metadata of a document, used by each worker when building the metadata of the documents
+
+    Parameters:
+        args : tuple of strings
+            The path to the document and the path to the OCR DB
+    Returns:
+        row : tuple | None
+            The file (relative to the OCR DB), folder, year, link, number of pages, number of bounding boxes and modification time
+            of the document, None if it couldn't be read
+    """
+    file,path_to_ocr_db = args
+    try:
+        mtime = os.path.getmtime(file)
+        document = read_document(file)
+        q_file = os.path.relpath(file,path_to_ocr_db)
+        year = int(document['date'].split('/')[-1])
+        n_bboxes = sum(len(elems) for elems in document['pages'].values())
+        return (q_file,q_file.split(os.sep)[0],year,document.get('document_href'),len(document['pages']),n_bboxes,mtime)
+    except Exception as e:
+        print()
+        print(f"{file}: {e}")
+        return None
+
+def build_documents_metadata(conn, path_to_ocr_db : str, n_workers : int = os.cpu_count(), subfolder : str | None = None):
+    """
+    Builds or updates the table with the metadata of the documents, reading only the new or changed files with a pool of processes
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+        path_to_ocr_db : string
+            The OCR DB, the paths of the documents are relative to it
+        n_workers : integer
+            The number of processes reading the files
+        subfolder : string | None
+            A folder inside the OCR DB, if given only its documents are updated and the rest are left as they are
+    """
+    tI = t.time()
+    s.create_documents_table(conn)
+    cursor = conn.cursor()
+    known_mtimes = s.get_documents_mtime(cursor)
+    if subfolder is not None:
+        prefix = os.path.join(os.path.normpath(subfolder),"")
+        known_mtimes = {file: mtime for file,mtime in known_mtimes.items() if file.startswith(prefix)}
+    files = filter_files(get_filenames_from_folder(path_to_ocr_db if subfolder is None else os.path.join(path_to_ocr_db,subfolder)),"json")
+    current_files = set()
+    changed = []
+    for file in files:
+        q_file = os.path.relpath(file,path_to_ocr_db)
+        current_files.add(q_file)
+        if known_mtimes.get(q_file) != os.path.getmtime(file):
+            changed.append((file,path_to_ocr_db))
+    rows = []
+    if len(changed) > 0:
+        with Pool(n_workers) as pool:
+            for row in tqdm(pool.imap(get_document_metadata,changed,chunksize=64),'documents',total=len(changed)):
+                if row is not None:
+                    rows.append(row)
+    s.add_documents(cursor,rows)
+    # Remove the documents that don't exist anymore
+    s.delete_documents(cursor,[file for file in known_mtimes if file not in current_files])
+    conn.commit()
+    print(f"Metadata of {len(rows)} documents updated in {t.time()-tI}")
+
+def get_n_files_per_year(folder, conn=None, path_to_ocr_db=None):
+    """
+    Counts the documents of each year
+
+    Parameters:
+        folder : string
+            The folder with the JSON documents
+        conn: sqlite3 connection object | None
+            A connection to the DB, if given the counts come from the metadata of the documents, which is updated first
+        path_to_ocr_db : string | None
+            The OCR DB containing the folder, needed when conn is given, the metadata of the documents is always relative to it
+    Returns:
+        n_docs_year : dictionary
+            The number of documents of each year
+    """
+    if conn is not None:
+        subfolder = os.path.relpath(folder,path_to_ocr_db)
+        subfolder = None if subfolder == "." else subfolder
+        build_documents_metadata(conn,path_to_ocr_db,subfolder=subfolder)
+        return s.get_n_docs_per_year(conn.cursor(),None if subfolder is None else [subfolder])
     files = get_filenames_from_folder(folder)
     n_docs_year = {}
     for file in tqdm(files):
-        file_cont = json.load(open(file,"r"))
+        file_cont = read_document(file)
         year = int(file_cont['date'].split('/')[-1])
         if year not in n_docs_year:
             n_docs_year[year] = 1
@@ -201,12 +394,82 @@ def get_n_files_per_year(folder):
             n_docs_year[year] += 1
     return n_docs_year
 
-def make_files_years_doc(path_to_ocr_db,path_to_save):
+def make_files_years_doc(path_to_ocr_db, path_to_save, conn=None):
+    """
+    Saves the year of each document, with the path of the documents relative to the OCR DB
+
+    Parameters:
+        path_to_ocr_db : string
+            The folder with the JSON documents
+        path_to_save : string
+            Path to where the years are going to be saved
+        conn: sqlite3 connection object | None
+            A connection to the DB, if given the years come from the metadata of the documents, which is updated first
+    """
+    if conn is not None:
+        build_documents_metadata(conn,path_to_ocr_db)
+        save_json(s.get_files_years(conn.cursor()),path_to_save)
+        return
     file_year_dict = {}
     for file in tqdm(get_filenames_from_folder(path_to_ocr_db)):
-        q_file = '/'.join(file.split('/')[4:])
+        q_file = os.path.relpath(file,path_to_ocr_db)
         if q_file not in file_year_dict:
-            file_content = json.loads(open(file,"r").readline())
+            file_content = read_document(file)
             year = int(file_content['date'].split('/')[-1])
             file_year_dict[q_file] = year
     save_json(file_year_dict,path_to_save)
+
+def save_strings(strings, prefix : str):
+    """
+    Saves a list of strings as a single UTF-8 buffer (prefix.bin) and the offset of each string in it (prefix_offsets.npy)
+
+    Parameters:
+        strings : iterable of strings
+            The strings to be saved
+        prefix : string
+            Path to where the strings are going to be saved, without extension
+    """
+    if not os.path.exists(os.path.dirname(prefix)):
+        os.makedirs(os.path.dirname(prefix))
+    offsets = [0]
+    with open(f"{prefix}.bin","wb") as blob_out:
+        for string in strings:
+            encoded = string.encode("utf-8")
+            blob_out.write(encoded)
+            offsets.append(offsets[-1]+len(encoded))
+    np.save(f"{prefix}_offsets.npy",np.asarray(offsets,dtype=np.int64))
+
+class MappedStrings:
+    """
+    Read-only list of strings saved with save_strings, the buffer is memory-mapped and each string is decoded when accessed
+    """
+    def __init__(self, prefix : str):
+        self.offsets = np.load(f"{prefix}_offsets.npy",mmap_mode='r')
+        if os.path.getsize(f"{prefix}.bin") > 0:
+            self.blob = np.memmap(f"{prefix}.bin",dtype=np.uint8,mode='r')
+        else:
+            self.blob = np.zeros(0,dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.offsets)-1
+
+    def get_bytes(self, idx : int) -> memoryview:
+        """
+        Returns the UTF-8 bytes of a string without copying them
+        """
+        if idx < 0:
+            idx += len(self)
+        return memoryview(self.blob[self.offsets[idx]:self.offsets[idx+1]])
+
+    def __getitem__(self, idx):
+        if isinstance(idx,slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("string index out of range")
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx+1]]).decode("utf-8")
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
@@ -7,6 +7,9 @@ LETTERS = "abcdefghijklmnopqrstuvwxyzñç0123456789"
 LETTERS_LIST = np.asarray([l for l in LETTERS],str)
 LETTERS_SET = set(LETTERS)
 LEVELS = 3
+# Lookup table from unicode code point to histogram position, -1 for characters outside the abecedary
+LETTERS_LUT = np.full(0x110000,-1,np.int16)
+LETTERS_LUT[[ord(l) for l in LETTERS]] = np.arange(len(LETTERS),dtype=np.int16)
 
 # Related to cleaning the words
 SYMBOLS_REGEX = re.compile(r'[,;.:¡!¿?@#$%&[\](){}<>~=+\-*/|\\_^`"\']')
@@ -17,6 +20,9 @@ SUBSTITUTION_REGEX = [
     (re.compile('ó'),'o'),
     (re.compile('ú|ü'),'u'),
 ]
+# Translation tables equivalent to SYMBOLS_REGEX and SUBSTITUTION_REGEX, used when cleaning many words
+SYMBOLS_TABLE = str.maketrans('','',',;.:¡!¿?@#$%&[](){}<>~=+-*/|\\_^`"\'')
+SUBSTITUTION_TABLE = str.maketrans('áéíïóúü','aeiiouu')
 
 def clean_word(word : str) -> str:
     """
@@ -37,6 +43,19 @@ def clean_word(word : str) -> str:
         l_word = regex.sub(replace,l_word)
     return l_word
 
+def clean_word_fast(word : str) -> str:
+    """
+    Same as clean_word, but using translation tables instead of regular expressions
+
+    Parameters:
+        word : string
+            The word to be cleaned
+    Returns:
+        l_word : string
+            The word after cleaning
+    """
+    return word.translate(SYMBOLS_TABLE).lower().translate(SUBSTITUTION_TABLE)
+
 
 def get_splits(word : str, level : int) -> list[list[str]]:
     """
@@ -127,3 +146,61 @@ def PHOC(o_word : str, last_level : int = LEVELS) -> list[int]:
     for i in range(0,last_level):
         pyramid = pyramid + create_hist(word,splits[i])
     return pyramid
+
+
+def PHOC_batch(o_words : list[str], last_level : int = LEVELS, dtype=np.float32, chunk_size : int = 100000) -> np.ndarray:
+    """
+    Creates the PHOC of given levels for every word in a list, the result of each row is the same as calling PHOC for the word
+
+    Parameters:
+        o_words : list of strings
+            The words to which PHOC is being applied to
+        last_level : integer
+            The number of levels wanted for PHOC
+        dtype : numpy dtype
+            The type of the returned matrix, float32 by default (the type used by Annoy), uint8 can be used to save memory
+        chunk_size : integer
+            The number of words encoded at the same time, bounds the memory used by the intermediate arrays
+    Returns:
+        pyramids : numpy array
+            A contiguous matrix of shape (len(o_words), F) with the PHOC of each word in a row
+    """
+    assert(type(last_level) == int)
+
+    n_letters = len(LETTERS)
+    F = n_letters*(2**last_level - 1)
+    pyramids = np.zeros((len(o_words),F),dtype=dtype)
+    for c_start in range(0,len(o_words),chunk_size):
+        words = [clean_word_fast(w) for w in o_words[c_start:c_start+chunk_size]]
+        n_words = len(words)
+        lengths = np.fromiter((len(w) for w in words),np.int64,n_words)
+        if lengths.sum() == 0:
+            continue
+        # Code points of all the characters of the chunk and the word (row) each one belongs to
+        chars = np.frombuffer(''.join(words).encode('utf-32-le'),np.uint32)
+        letters = LETTERS_LUT[chars].astype(np.int64)
+        rows = np.repeat(np.arange(n_words),lengths)
+        # Position of each character inside its word
+        starts = np.cumsum(lengths) - lengths
+        pos = np.arange(len(chars)) - np.repeat(starts,lengths)
+        # Only characters in the abecedary add to the histograms
+        valid = letters >= 0
+        letters, rows, pos = letters[valid], rows[valid], pos[valid]
+        # Split bounds of the split each character belongs to, the whole word for the first level
+        split_start = np.zeros_like(pos)
+        split_end = lengths[rows]
+        split_idx = np.zeros_like(pos)
+        cols = []
+        for level in range(last_level):
+            if level > 0:
+                # Same splitting as get_splits, the first half takes ceil(len/2) characters
+                mid = split_start + (split_end - split_start + 1)//2
+                right = pos >= mid
+                split_idx = split_idx*2 + right
+                split_start = np.where(right,mid,split_start)
+                split_end = np.where(right,split_end,mid)
+            cols.append(n_letters*(2**level - 1) + split_idx*n_letters + letters)
+        flat = np.tile(rows,last_level)*F + np.concatenate(cols)
+        counts = np.bincount(flat,minlength=n_words*F)
+        pyramids[c_start:c_start+n_words] = counts.reshape(n_words,F)
+    return pyramids
@@ -1,10 +1,15 @@
+from multiprocessing import Pool
 from annoy import AnnoyIndex
 import time_manager as tm
 import file_manager as fm
+import sqlite_manager as s
 from tqdm import tqdm
 from common import *
+import numpy as np
 import math as m
+import threading
 import time as t
+import hashlib
 import pickle
 import phoc
 import os
@@ -12,6 +17,125 @@ import os
 F = len(phoc.LETTERS)*sum([int(m.pow(2,i)) for i in range(phoc.LEVELS)])
 N_TREES = 100
 
+def add_words_to_index(ann_idx,words,req_level,first_item=0,chunk_size=100000):
+    """
+    Adds the PHOC descriptor of each word to an Annoy index, the descriptors are created in batches
+
+    Parameters:
+        ann_idx : AnnoyIndex
+            The index to which the descriptors are added
+        words : list of strings
+            The words to be added, the item of each word is first_item plus its position in the list
+        req_level : integer
+            The number of levels of the PHOC descriptors
+        first_item : integer
+            The item assigned to the first word of the list
+        chunk_size : integer
+            The number of words encoded at the same time
+    """
+    for c_start in range(0,len(words),chunk_size):
+        vectors = phoc.PHOC_batch(words[c_start:c_start+chunk_size],req_level)
+        for i,v in enumerate(vectors):
+            ann_idx.add_item(first_item+c_start+i,v)
+
+def add_file_words(words_in_index,file):
+    """
+    Adds the words of all sections of a file to the indexed words, counting the repetitions of each word per file and section
+
+    Parameters:
+        words_in_index : dictionary
+            The indexed words, with the repetitions of each word per file and section
+        file : string
+            The path to the JSON file from which to get the words
+    """
+    text_sects = fm.get_bbox_from_JSON(file)
+    # For each section of text
+    for sect in text_sects:
+        # For each word in the section
+        for word in sect[2].split():
+            # If the word has not been added to the index
+            if word not in words_in_index:
+                # Add the word to the indexed words, including the file and section in which it has been found
+                words_in_index[word] = {file:{sect[0]:1}}
+            else:
+                # Update the repetitions of the word, adding the new file and section pair in which it has been found
+                #words_in_index[word].append([file,sect[0]])
+                if file in words_in_index[word]:
+                    if sect[0] in words_in_index[word][file]:
+                        words_in_index[word][file][sect[0]] += 1
+                    else:
+                        words_in_index[word][file][sect[0]] = 1
+                else:
+                   words_in_index[word][file] = {sect[0]:1}
+
+def get_files_words(files):
+    """
+    Gets the indexed words of a list of files, used by each worker when creating an annoy file in parallel
+
+    Parameters:
+        files : list of strings
+            The paths to the JSON files from which to get the words
+    Returns:
+        words_in_index : dictionary
+            The words found in the files, in order of appearance, with their repetitions per file and section
+        exceptions : dictionary
+            The error found in each file that couldn't be read
+        time : float
+            The time the worker needed to read the files
+    """
+    tI = t.time()
+    words_in_index = {}
+    exceptions = {}
+    for file in files:
+        # This try/except is due to a problem when reading the JSON files:
+        # json.decoder.JSONDecodeError: Expecting ',' delimiter
+        try:
+            add_file_words(words_in_index,file)
+        except Exception as e:
+            exceptions[file] = str(e)
+    return words_in_index,exceptions,t.time()-tI
+
+def merge_words_in_index(words_in_index,partial_words):
+    """
+    Merges the words found by a worker into the indexed words, new words are appended after the already indexed ones
+
+    Parameters:
+        words_in_index : dictionary
+            The indexed words, with the repetitions of each word per file and section
+        partial_words : dictionary
+            The words found by a worker, with the repetitions of each word per file and section
+    """
+    for word,files in partial_words.items():
+        if word not in words_in_index:
+            words_in_index[word] = files
+        else:
+            # Workers get disjoint lists of files, so the files of a word are never repeated
+            words_in_index[word].update(files)
+
+def save_annoy_index(ann_idx,annoy_filename,n_trees=N_TREES,n_jobs=-1):
+    """
+    Builds an annoy index and saves it to a file
+
+    Parameters:
+        ann_idx : AnnoyIndex
+            The index with all the items already added
+        annoy_filename : string
+            Path to where the index is going to be saved
+        n_trees : integer
+            The number of trees of the index
+        n_jobs : integer
+            The number of threads used to build the trees, -1 to use all the cores
+    """
+    tI = t.time()
+    ann_idx.build(n_trees,n_jobs=n_jobs)
+    print()
+    tm.print_time((t.time()-tI),"to build index")
+    if not os.path.exists(os.path.dirname(annoy_filename)):
+        os.mkdir(os.path.dirname(annoy_filename))
+    tI = t.time()
+    ann_idx.save(annoy_filename)
+    tm.print_time((t.time()-tI),"to save the annoy file")
+
 def create_annoy_file(folder,req_level,save_annoy,annoy_filename,save_repetitions,rep_filename):
     """
     Creates an annoy index file and words repetition file for all words in all files of a given folder
@@ -20,50 +144,21 @@ def create_annoy_file(folder,req_level,save_annoy,annoy_filename,save_repetition
     all_f = fm.get_filenames_from_folder(folder)
     json_only = fm.filter_files(all_f,"json")
 
-    i = 0
     words_in_index = {}
     for file in tqdm(json_only,'files'):
         # This try/except is due to a problem when reading the JSON files:
         # json.decoder.JSONDecodeError: Expecting ',' delimiter
         try:
-            text_sects = fm.get_bbox_from_JSON(file)
-            # For each section of text
-            for sect in text_sects:
-                # For each word in the section
-                for word in sect[1].split():
-                    # If the word has not been added to the index
-                    if word not in words_in_index:
-                        # Create the PHOC descriptor
-                        v = phoc.PHOC(word,req_level)
-                        # Add the word to the Annoy index
-                        ann_idx.add_item(i,v)
-                        # Add the word to the indexed words, including the file and section in which it has been found
-                        words_in_index[word] = {file:{sect[0]:1}}
-                        i+=1
-                    else:
-                        # Update the repetitions of the word, adding the new file and section pair in which it has been found
-                        #words_in_index[word].append([file,sect[0]])
-                        if file in words_in_index[word]:
-                            if sect[0] in words_in_index[word][file]:
-                                words_in_index[word][file][sect[0]] += 1
-                            else:
-                                words_in_index[word][file][sect[0]] = 1
-                        else:
-                           words_in_index[word][file] = {sect[0]:1}
+            add_file_words(words_in_index,file)
         except Exception as e:
             print()
             print(e)
+
+    # Create the PHOC descriptors of all the words, the item of each word is the order in which it was found
+    add_words_to_index(ann_idx,list(words_in_index.keys()),req_level)
     
     if save_annoy:
-        tI = t.time()
-        ann_idx.build(N_TREES)
-        print()
-        tm.print_time((t.time()-tI),"to build index")
-        if not os.path.exists(os.path.dirname(annoy_filename)):
-            os.mkdir(os.path.dirname(annoy_filename))
-        tI = t.time()
-        ann_idx.save(annoy_filename)
-        tm.print_time((t.time()-tI),"to save the annoy file")
+        save_annoy_index(ann_idx,annoy_filename)
     
     if save_repetitions:
         tI = t.time()
@@ -73,7 +168,60 @@ def create_annoy_file(folder,req_level,save_annoy,annoy_filename,save_repetition
         pickle.dump(words_in_index, pickle_out,pickle.HIGHEST_PROTOCOL)
         pickle_out.close()
         tm.print_time((t.time()-tI),"to save the repetitions file")
-        del ann_idx
+
+def create_annoy_file_parallel(folder,req_level,save_annoy,annoy_filename,save_repetitions,rep_filename,n_workers=os.cpu_count(),files_per_shard=500):
+    """
+    Creates the same annoy index file and words repetition file as create_annoy_file, reading the files of the folder with a pool of processes
+
+    The files are split in shards that are read by the workers, the partial vocabularies are merged in the order of the shards,
+    so each word gets the same item as when the files are read one after the other
+
+    Parameters:
+        folder : string
+            The folder from which to get the JSON files
+        req_level : integer
+            The number of levels of the PHOC descriptors
+        save_annoy : bool
+            If the annoy index is to be saved
+        annoy_filename : string
+            Path to where the annoy index is going to be saved
+        save_repetitions : bool
+            If the repetitions of the words are to be saved
+        rep_filename : string
+            Path to where the repetitions of the words are going to be saved
+        n_workers : integer
+            The number of processes reading the files, all the cores by default
+        files_per_shard : integer
+            The number of files read by a worker at a time
+    Returns:
+        words_in_index : dictionary
+            The indexed words, with the repetitions of each word per file and section
+    """
+    all_f = fm.get_filenames_from_folder(folder)
+    json_only = fm.filter_files(all_f,"json")
+    shards = [json_only[i:i+files_per_shard] for i in range(0,len(json_only),files_per_shard)]
+
+    words_in_index = {}
+    workers_time = 0
+    tI = t.time()
+    with Pool(n_workers) as pool:
+        # imap returns the results in the same order as the shards, which keeps the items stable
+        for partial_words,exceptions,time in tqdm(pool.imap(get_files_words,shards),'shards',total=len(shards)):
+            merge_words_in_index(words_in_index,partial_words)
+            workers_time += time
+            for file,e in exceptions.items():
+                print()
+                print(f"{file}: {e}")
+    tm.print_time((t.time()-tI),f"to read {len(json_only)} files with {n_workers} workers ({workers_time:0.2f} s of work)")
+
+    ann_idx = AnnoyIndex(F, 'angular')
+    # Create the PHOC descriptors of all the words, the item of each word is the order in which it was found
+    add_words_to_index(ann_idx,list(words_in_index.keys()),req_level)
+
+    if save_annoy:
+        save_annoy_index(ann_idx,annoy_filename)
+
+    if save_repetitions:
         tI = t.time()
         if not os.path.exists(os.path.dirname(rep_filename)):
             os.mkdir(os.path.dirname(rep_filename))
@@ -81,8 +229,509 @@ def create_annoy_file(folder,req_level,save_annoy,annoy_filename,save_repetition
         pickle.dump(words_in_index, pickle_out,pickle.HIGHEST_PROTOCOL)
         pickle_out.close()
         tm.print_time((t.time()-tI),"to save the repetitions file")
+    return words_in_index
+
+def create_annoy_file_streaming(conn,folder,req_level,annoy_filename,words_filename,max_memory_mb=1024):
+    """
+    Creates an annoy index file for all words in all files of a given folder, writing the repetitions straight to the DB instead of keeping them in memory
+    The unique index of the words table is kept as it is, to load many folders fast use create_annoy_files_streaming
+
+    The repetitions of each file are streamed to the words table in batches whose size depends on max_memory_mb, only the map from
+    each word to its item is kept in memory, and the items of the index are stored in the annoy file while it is built
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+        folder : string
+            The name of the folder inside the OCR DB
+        req_level : integer
+            The number of levels of the PHOC descriptors
+        annoy_filename : string
+            Path to where the annoy index is going to be saved
+        words_filename : string
+            Path to where the list with the word of each item is going to be saved
+        max_memory_mb : integer
+            Approximate memory used by the repetitions waiting to be inserted, the map from words to items isn't included
+    Returns:
+        n_words : integer
+            The number of words in the index
+    """
+    all_f = fm.get_filenames_from_folder(PATH_TO_OCR_DB+folder)
+    json_only = fm.filter_files(all_f,"json")
+    if not os.path.exists(os.path.dirname(annoy_filename)):
+        os.mkdir(os.path.dirname(annoy_filename))
+    # Building again a folder replaces its rows and indexed files instead of adding them a second time
+    s.delete_folder_rows(conn,folder)
+    ann_idx = AnnoyIndex(F, 'angular')
+    # Store the items in a temporary file instead of in memory, the old index may be memory-mapped by other processes
+    ann_idx.on_disk_build(annoy_filename+".tmp")
+
+    words_to_items = {}
+    new_words = []
+    indexed_files = []
+    def get_rows():
+        # Each row takes a few hundred bytes in memory
+        for file in tqdm(json_only,'files'):
+            try:
+                rows = get_file_rows(file)
+            except Exception as e:
+                print()
+                print(f"{file}: {e}")
+                continue
+            for row in rows:
+                if row[0] not in words_to_items:
+                    words_to_items[row[0]] = len(words_to_items)
+                    new_words.append(row[0])
+                yield row
+            indexed_files.append((os.path.relpath(file,PATH_TO_OCR_DB),os.path.getmtime(file)))
+            # Create the PHOC descriptors of the new words in batches
+            if len(new_words) >= 100000:
+                add_words_to_index(ann_idx,new_words,req_level,len(words_to_items)-len(new_words))
+                new_words.clear()
+    # The unique index is rebuilt by the caller once all the folders are loaded, see create_annoy_files_streaming
+    s.bulk_add_rows(conn,get_rows(),batch_size=max(1000,(max_memory_mb*2**20)//400),rebuild_index=False)
+    add_words_to_index(ann_idx,new_words,req_level,len(words_to_items)-len(new_words))
+
+    tI = t.time()
+    ann_idx.build(N_TREES,n_jobs=-1)
+    print()
+    tm.print_time((t.time()-tI),"to build index")
+    ann_idx.unload()
+    fm.save_json(list(words_to_items.keys()),words_filename+".tmp")
+    os.replace(annoy_filename+".tmp",annoy_filename)
+    os.replace(words_filename+".tmp",words_filename)
+    # The words of the delta index are in the new index
+    for delta_filename in get_delta_filenames(folder):
+        if os.path.exists(delta_filename):
+            os.remove(delta_filename)
+
+    # Keep track of the indexed files so new files can be added incrementally
+    s.create_indexed_files_table(conn)
+    cursor = conn.cursor()
+    cursor.executemany("INSERT OR REPLACE INTO indexed_files VALUES (?, ?, ?, NULL)",[(file,folder,mtime) for file,mtime in indexed_files])
+    if not s.folder_exists(conn,folder):
+        s.add_folder(cursor,folder)
+    conn.commit()
+    return len(words_to_items)
+
+def create_annoy_files_streaming(conn,req_level=phoc.LEVELS,max_memory_mb=1024):
+    """
+    Creates the annoy index files of all folders with create_annoy_file_streaming
+    The unique index of the words table is dropped once before loading the folders and added again once at the end, instead of being
+    rebuilt over the whole table after each folder
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+        req_level : integer
+            The number of levels of the PHOC descriptors
+        max_memory_mb : integer
+            Approximate memory used by the repetitions waiting to be inserted
+    """
+    s.drop_index(conn)
+    for folder in get_folders():
+        create_annoy_file_streaming(conn,folder,req_level,f"{ANNOY_IDXS_PATH}{folder}.ann",f"{IDXS_2_WORDS_PATH}{folder}.json",max_memory_mb)
+    s.add_index(conn)
+
+GLOBAL_INDEX_NAME = "global"
+
+def get_global_filenames():
+    """
+    Returns the names of the files of the global index: the annoy index, its words and the folders of each word (postings)
+    """
+    return (f"{ANNOY_IDXS_PATH}{GLOBAL_INDEX_NAME}.ann",f"{IDXS_2_WORDS_PATH}{GLOBAL_INDEX_NAME}.json",
+            f"{IDXS_2_WORDS_PATH}{GLOBAL_INDEX_NAME}_folders.json",f"{IDXS_2_WORDS_PATH}{GLOBAL_INDEX_NAME}_postings.npy")
+
+def create_global_annoy_file(req_level=phoc.LEVELS):
+    """
+    Creates a single annoy index with the different words of the indexes of all folders, each word has only one vector
+    The folders in which each word appears are saved as a bit mask per item (postings), bit i is set if the word is in the i-th folder,
+    the files of each word are already in the DB
+
+    Parameters:
+        req_level : integer
+            The number of levels of the PHOC descriptors
+    """
+    tI = t.time()
+    annoy_filename,words_filename,folders_filename,postings_filename = get_global_filenames()
+    folders = get_folders()
+    assert len(folders) <= 64, "The postings of the global index have one bit per folder"
+    word_items = {}
+    postings = []
+    for i,folder in enumerate(tqdm(folders,'folders')):
+        folder_words = fm.load_json(f"{IDXS_2_WORDS_PATH}{folder}.json")
+        _,delta_words_filename = get_delta_filenames(folder)
+        if os.path.exists(delta_words_filename):
+            folder_words += fm.load_json(delta_words_filename)
+        for word in folder_words:
+            item = word_items.setdefault(word,len(word_items))
+            if item == len(postings):
+                postings.append(0)
+            postings[item] |= 1 << i
+    words = list(word_items.keys())
+
+    ann_idx = AnnoyIndex(F, 'angular')
+    add_words_to_index(ann_idx,words,req_level)
+    # Save to temporary files and replace the old ones, so processes using the old index can keep doing it
+    save_annoy_index(ann_idx,annoy_filename+".tmp")
+    fm.save_json(words,words_filename+".tmp")
+    np.save(postings_filename+".tmp.npy",np.asarray(postings,dtype=np.uint64))
+    fm.save_json(folders,folders_filename+".tmp")
+    os.replace(annoy_filename+".tmp",annoy_filename)
+    os.replace(words_filename+".tmp",words_filename)
+    os.replace(postings_filename+".tmp.npy",postings_filename)
+    os.replace(folders_filename+".tmp",folders_filename)
+    print(f"Global index with {len(words)} words created in {t.time()-tI}")
 
 def load_annoy_file(filename,f=F):
     u = AnnoyIndex(f, 'angular')
     u.load(filename)
     return u
+
+# Process-wide registry of the loaded (memory-mapped) annoy indexes, with the modification time of each file when it was loaded
+LOADED_INDEXES = {}
+LOADED_INDEXES_LOCK = threading.Lock()
+
+def get_annoy_index(filename,f=F):
+    """
+    Returns the annoy index of a file, the file is memory-mapped the first time and the same index is reused afterwards
+
+    If the file has been replaced since it was loaded (e.g. after merge_delta_index) it is loaded again, the old index is
+    never unloaded explicitly because other threads may be searching it, its memory map is freed when the last reference is dropped
+
+    Parameters:
+        filename : string
+            Path to the annoy file
+        f : integer
+            The length of the vectors of the index
+    Returns:
+        ann_idx : AnnoyIndex
+            The loaded index
+    """
+    mtime = os.path.getmtime(filename)
+    with LOADED_INDEXES_LOCK:
+        if filename in LOADED_INDEXES:
+            ann_idx,loaded_mtime = LOADED_INDEXES[filename]
+            if loaded_mtime == mtime:
+                return ann_idx
+        ann_idx = load_annoy_file(filename,f)
+        LOADED_INDEXES[filename] = (ann_idx,mtime)
+        return ann_idx
+
+def close_annoy_index(filename):
+    """
+    Removes the annoy index of a file from the registry, if it had been loaded
+    The index is unloaded when the threads still using it drop their references
+    """
+    with LOADED_INDEXES_LOCK:
+        LOADED_INDEXES.pop(filename,None)
+
+def close_annoy_indexes():
+    """
+    Removes all the annoy indexes from the registry, their memory maps are freed when no thread uses them anymore
+    """
+    with LOADED_INDEXES_LOCK:
+        LOADED_INDEXES.clear()
+
+def get_file_rows(file):
+    """
+    Gets the repetitions of each word in each section of a file, as rows of the words table
+
+    Parameters:
+        file : string
+            The path to the JSON file from which to get the words
+    Returns:
+        rows : list of tuples
+            A list with the word, file (relative to the OCR DB), year, page, bounding box and repetitions of each word in each section
+    """
+    json_data = fm.read_document(file)
+    q_file = os.path.relpath(file,PATH_TO_OCR_DB)
+    year = int(json_data['date'].split('/')[-1])
+    rows = []
+    for page in json_data['pages'].keys():
+        for elems in json_data['pages'][page]:
+            bbox = str(elems['bbox'])
+            reps = {}
+            for word in elems['ocr'].split():
+                reps[word] = reps.get(word,0) + 1
+            rows += [(word,q_file,year,page,bbox,n_reps) for word,n_reps in reps.items()]
+    return rows
+
+def get_file_hash(file):
+    """
+    Returns the sha1 hash of the content of a file
+    """
+    with open(file,"rb") as f_in:
+        return hashlib.sha1(f_in.read()).hexdigest()
+
+def get_delta_filenames(folder):
+    """
+    Returns the paths to the delta annoy index and to the words of the delta index of a folder
+    """
+    return f"{ANNOY_IDXS_PATH}{folder}_delta.ann",f"{IDXS_2_WORDS_PATH}{folder}_delta.json"
+
+def save_delta_index(folder,delta_words,req_level):
+    """
+    Creates the delta annoy index of a folder with the given words and saves it with its words
+    """
+    delta_annoy_filename,delta_words_filename = get_delta_filenames(folder)
+    ann_idx = AnnoyIndex(F, 'angular')
+    add_words_to_index(ann_idx,delta_words,req_level)
+    save_annoy_index(ann_idx,delta_annoy_filename)
+    fm.save_json(delta_words,delta_words_filename)
+
+def seed_indexed_files(cursor,folder,use_hash=False):
+    """
+    Adds to the indexed files the files of a folder that are in the words table, with their current modification time
+
+    Parameters:
+        cursor: sqlite3 cursor object
+            A cursor of the DB
+        folder : string
+            The name of the folder inside the OCR DB
+        use_hash : bool
+            If the hash of the content of each file is to be stored too
+    Returns:
+        indexed_files : dict
+            The modification time and hash of each file, as returned by s.get_indexed_files
+    """
+    indexed_files = {}
+    for q_file in s.get_folder_files(cursor,folder):
+        file = PATH_TO_OCR_DB+q_file
+        # A file removed from the folder keeps its rows, but there is nothing to compare it to
+        if not os.path.exists(file):
+            continue
+        mtime = os.path.getmtime(file)
+        file_hash = get_file_hash(file) if use_hash else None
+        s.set_indexed_file(cursor,q_file,folder,mtime,file_hash)
+        indexed_files[q_file] = (mtime,file_hash)
+    return indexed_files
+
+def ingest_folder_incremental(conn,folder,req_level=phoc.LEVELS,use_hash=False):
+    """
+    Adds the new or changed files of a folder to the DB without rebuilding the annoy index of the folder
+
+    Only the rows of the new or changed files are inserted in the words table, the words that aren't in the folder's
+    index yet get a PHOC descriptor in a small delta index that is searched together with the main index
+    until merge_delta_index folds it into the main one
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+        folder : string
+            The name of the folder inside the OCR DB
+        req_level : integer
+            The number of levels of the PHOC descriptors
+        use_hash : bool
+            If a file whose modification time has changed is to be compared by the hash of its content before indexing it again
+    Returns:
+        changed_files : list of strings
+            The files that have been indexed
+        new_words : list of strings
+            The words that have been added to the delta index
+    """
+    s.create_indexed_files_table(conn)
+    cursor = conn.cursor()
+    indexed_files = s.get_indexed_files(cursor,folder)
+    if len(indexed_files) == 0 and s.folder_exists(conn,folder):
+        # The folder was indexed as a whole, its files are recorded once with their current modification time instead of indexing them again
+        indexed_files = seed_indexed_files(cursor,folder,use_hash)
+        conn.commit()
+    all_f = fm.get_filenames_from_folder(PATH_TO_OCR_DB+folder)
+    json_only = fm.filter_files(all_f,"json")
+
+    # Get the words already in the main and delta indexes of the folder
+    words_filename = f"{IDXS_2_WORDS_PATH}{folder}.json"
+    delta_annoy_filename,delta_words_filename = get_delta_filenames(folder)
+    main_words = fm.load_json(words_filename) if os.path.exists(words_filename) else []
+    delta_words = fm.load_json(delta_words_filename) if os.path.exists(delta_words_filename) else []
+    known_words = set(main_words) | set(delta_words)
+
+    changed_files = []
+    new_words = {}
+    # All the files are added in one transaction, releasing the savepoint of each file doesn't commit it
+    if not conn.in_transaction:
+        cursor.execute("BEGIN")
+    for file in tqdm(json_only,'files'):
+        q_file = os.path.relpath(file,PATH_TO_OCR_DB)
+        mtime = os.path.getmtime(file)
+        file_hash = None
+        if q_file in indexed_files:
+            old_mtime,old_hash = indexed_files[q_file]
+            if old_mtime == mtime:
+                continue
+            if use_hash:
+                file_hash = get_file_hash(file)
+                if old_hash == file_hash:
+                    s.set_indexed_file(cursor,q_file,folder,mtime,file_hash)
+                    continue
+        # The changes of each file are done inside a savepoint, so a file that fails leaves the DB as it was
+        cursor.execute("SAVEPOINT ingest_file")
+        try:
+            rows = get_file_rows(file)
+            # Replace the rows of the file if it is already in the DB
+            if q_file in indexed_files:
+                s.delete_file_rows(cursor,q_file)
+            cursor.executemany("INSERT INTO words_repetitions VALUES (?, ?, ?, ?, ?, ?)",rows)
+            if use_hash and file_hash is None:
+                file_hash = get_file_hash(file)
+            s.set_indexed_file(cursor,q_file,folder,mtime,file_hash)
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT ingest_file")
+            cursor.execute("RELEASE SAVEPOINT ingest_file")
+            print()
+            print(f"{file}: {e}")
+            continue
+        cursor.execute("RELEASE SAVEPOINT ingest_file")
+        for row in rows:
+            if row[0] not in known_words:
+                new_words[row[0]] = None
+        changed_files.append(q_file)
+    if not s.folder_exists(conn,folder):
+        s.add_folder(cursor,folder)
+    conn.commit()
+
+    new_words = list(new_words.keys())
+    if len(new_words) > 0:
+        save_delta_index(folder,delta_words+new_words,req_level)
+    print(f"{len(changed_files)} files indexed, {len(new_words)} new words added to the delta index of {folder}")
+    return changed_files,new_words
+
+def merge_delta_index(folder,req_level=phoc.LEVELS):
+    """
+    Folds the delta index of a folder into its main annoy index, meant to be run as a background job
+
+    The items of the words in the main index don't change, the words of the delta index are appended after them
+
+    Parameters:
+        folder : string
+            The name of the folder inside the OCR DB
+        req_level : integer
+            The number of levels of the PHOC descriptors
+    """
+    annoy_filename = f"{ANNOY_IDXS_PATH}{folder}.ann"
+    words_filename = f"{IDXS_2_WORDS_PATH}{folder}.json"
+    delta_annoy_filename,delta_words_filename = get_delta_filenames(folder)
+    if not os.path.exists(delta_words_filename):
+        print(f"{folder} has no delta index")
+        return
+    main_words = fm.load_json(words_filename) if os.path.exists(words_filename) else []
+    delta_words = fm.load_json(delta_words_filename)
+    words = main_words + delta_words
+
+    ann_idx = AnnoyIndex(F, 'angular')
+    add_words_to_index(ann_idx,words,req_level)
+    # Save to temporary files and replace the old ones, so processes using the old index can keep doing it
+    save_annoy_index(ann_idx,annoy_filename+".tmp")
+    fm.save_json(words,words_filename+".tmp")
+    os.replace(annoy_filename+".tmp",annoy_filename)
+    os.replace(words_filename+".tmp",words_filename)
+    os.remove(delta_annoy_filename)
+    os.remove(delta_words_filename)
+    # Keep the compact vocabulary of the folder in sync with its words if it is being used
+    vocabulary_prefix = get_vocabulary_prefix(folder)
+    if os.path.exists(f"{vocabulary_prefix}_ids.npy"):
+        save_vocabulary(words,vocabulary_prefix)
+
+def get_vocabulary_prefix(folder):
+    """
+    Returns the path, without extension, of the compact vocabulary of a folder
+    """
+    return f"{IDXS_2_WORDS_PATH}{folder}_vocabulary"
+
+VOCABULARY_SUFFIXES = [".bin","_offsets.npy","_ids.npy","_positions.npy"]
+
+def save_vocabulary(words,prefix):
+    """
+    Saves the words of an annoy index as a compact vocabulary: the words sorted in a single UTF-8 buffer with their offsets
+    (saved with fm.save_strings), the item of each sorted word (prefix_ids.npy) and the position of each item in the sorted words
+    (prefix_positions.npy)
+
+    Parameters:
+        words : list of strings
+            The word of each item of the index
+        prefix : string
+            Path to where the vocabulary is going to be saved, without extension
+    """
+    # Python orders strings by code point, which is the same order as their UTF-8 bytes
+    ids = np.asarray(sorted(range(len(words)),key=words.__getitem__),dtype=np.int64)
+    positions = np.empty(len(words),dtype=np.int64)
+    positions[ids] = np.arange(len(words),dtype=np.int64)
+    # Save to temporary files and replace the old ones, the old files may be memory-mapped by other processes
+    fm.save_strings((words[item] for item in ids),prefix+"_tmp")
+    np.save(prefix+"_tmp_ids.npy",ids)
+    np.save(prefix+"_tmp_positions.npy",positions)
+    for suffix in VOCABULARY_SUFFIXES:
+        os.replace(prefix+"_tmp"+suffix,prefix+suffix)
+
+def convert_words_file(words_filename,prefix):
+    """
+    Converts the JSON list with the words of an annoy index into a compact vocabulary
+    """
+    tI = t.time()
+    words = fm.load_json(words_filename)
+    save_vocabulary(words,prefix)
+    print(f"{len(words)} words converted in {t.time()-tI}")
+
+def convert_words_files():
+    """
+    Converts the JSON lists with the words of the annoy indexes of all folders into compact vocabularies
+    """
+    for folder in get_folders():
+        convert_words_file(f"{IDXS_2_WORDS_PATH}{folder}.json",get_vocabulary_prefix(folder))
+
+class Vocabulary:
+    """
+    Read-only list with the word of each item of an annoy index, saved with save_vocabulary
+
+    The files are memory-mapped, so only the pages of the words being accessed are kept in memory instead of a python string per word
+    """
+    def __init__(self, prefix):
+        self.sorted_words = fm.MappedStrings(prefix)
+        self.ids = np.load(f"{prefix}_ids.npy",mmap_mode='r')
+        self.positions = np.load(f"{prefix}_positions.npy",mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, item):
+        if isinstance(item,slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError("vocabulary index out of range")
+        return self.sorted_words[int(self.positions[item])]
+
+    def __iter__(self):
+        for item in range(len(self)):
+            yield self[item]
+
+    def __contains__(self, word):
+        return self.find(word) != -1
+
+    def find(self, word):
+        """
+        Returns the item of a word, -1 if the word isn't in the vocabulary
+        """
+        target = word.encode("utf-8")
+        # Binary search over the sorted words, comparing their UTF-8 bytes
+        lo,hi = 0,len(self)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if bytes(self.sorted_words.get_bytes(mid)) < target:
+                lo = mid+1
+            else:
+                hi = mid
+        if lo < len(self) and bytes(self.sorted_words.get_bytes(lo)) == target:
+            return int(self.ids[lo])
+        return -1
+
+    def index(self, word):
+        """
+        Returns the item of a word, like list.index
+        """
+        item = self.find(word)
+        if item == -1:
+            raise ValueError(f"{word!r} is not in the vocabulary")
+        return item
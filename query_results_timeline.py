@@ -1,7 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
 import matplotlib.figure
 import matplotlib.pyplot as plt
 import matplotlib.pyplot
+import threading
 import sqlite_manager as s
 import file_manager as fm
 import phoc_annoy as ann
@@ -13,32 +15,277 @@ import numpy as np
 import matplotlib
 import time as t
 import json
+import os
 import phoc
 
 matplotlib.use('agg')
-DB = s.connect_db(SQLITE_DB_PATH)
-DOCS_YEAR = {int(k): int(v) for k,v in fm.load_json(DOCS_PER_YEAR_PATH).items()}
 THRESHOLD = 0.4
 
+# Resources loaded the first time they are used, so importing this module doesn't open the DB nor read the vocabularies
+RESOURCES = {}
+RESOURCES_LOCK = threading.Lock()
+# Each thread has its own connection to the DB, so the temporary tables and transactions of concurrent queries don't interfere
+THREAD_RESOURCES = threading.local()
 
-FOLDERS_FILES = []
-for folder in FOLDERS:
-        words_file = f"{PATH_TO_ANN_PHOC_FILES}/idxs_2_words_v2/{folder}.json"
-        words_list = fm.load_json(words_file)
-        FOLDERS_FILES.append([words_list])
+def get_db():
+    """
+    Returns the connection to the DB of the current thread, it is opened the first time the thread uses it
+    """
+    if not hasattr(THREAD_RESOURCES,"db"):
+        THREAD_RESOURCES.db = s.connect_db(SQLITE_DB_PATH)
+    return THREAD_RESOURCES.db
+
+def load_folder_words(folder : str) -> list[str] | ann.Vocabulary:
+    """
+    Loads the word of each item of the main index of a folder, from its compact vocabulary if it is up to date with the JSON file
+    of the words, which is only read otherwise
+
+    Parameters:
+        folder : string
+            The name of the folder
+    Returns:
+        words : list of strings | Vocabulary
+            The word of each item of the index
+    """
+    words_file = f"{IDXS_2_WORDS_PATH}{folder}.json"
+    vocabulary_prefix = ann.get_vocabulary_prefix(folder)
+    if os.path.exists(f"{vocabulary_prefix}_ids.npy") and (not os.path.exists(words_file) or os.path.getmtime(f"{vocabulary_prefix}_ids.npy") >= os.path.getmtime(words_file)):
+        return ann.Vocabulary(vocabulary_prefix)
+    # A folder indexed only incrementally has a delta index but no main index yet
+    return fm.load_json(words_file) if os.path.exists(words_file) else []
+
+def get_folders_files() -> list[list[list[str]]]:
+    """
+    Returns the words of the main and delta indexes of each folder, they are loaded only the first time
+    """
+    with RESOURCES_LOCK:
+        if "FOLDERS_FILES" not in RESOURCES:
+            folders_files = []
+            for folder in get_folders():
+                words_list = load_folder_words(folder)
+                # Words of the delta index of the folder, with items after the ones of the main index
+                _,delta_words_file = ann.get_delta_filenames(folder)
+                delta_words_list = fm.load_json(delta_words_file) if os.path.exists(delta_words_file) else []
+                folders_files.append([words_list,delta_words_list])
+            RESOURCES["FOLDERS_FILES"] = folders_files
+        return RESOURCES["FOLDERS_FILES"]
+
+def get_global_index() -> dict:
+    """
+    Returns the annoy index, words, folders and postings of the global index, the index comes from the registry of annoy indexes and
+    the rest is loaded the first time and again if the index has been rebuilt
+    """
+    annoy_filename,words_filename,folders_filename,postings_filename = ann.get_global_filenames()
+    annoy_idx = ann.get_annoy_index(annoy_filename,266)
+    mtime = os.path.getmtime(annoy_filename)
+    with RESOURCES_LOCK:
+        if "GLOBAL_INDEX" not in RESOURCES or RESOURCES["GLOBAL_INDEX"]["mtime"] != mtime:
+            RESOURCES["GLOBAL_INDEX"] = {"mtime": mtime, "words": load_folder_words(ann.GLOBAL_INDEX_NAME),
+                                         "folders": fm.load_json(folders_filename), "postings": np.load(postings_filename,mmap_mode='r')}
+        return dict(RESOURCES["GLOBAL_INDEX"],index=annoy_idx)
+
+def get_file_year() -> dict:
+    """
+    Returns the year of each file, it is loaded only the first time
+    """
+    with RESOURCES_LOCK:
+        if "FILE_YEAR" not in RESOURCES:
+            RESOURCES["FILE_YEAR"] = {k: int(v) for k,v in fm.load_json(DOCS_YEARS_PATH).items()}
+        return RESOURCES["FILE_YEAR"]
+
+def get_search_pool() -> ThreadPoolExecutor:
+    """
+    Returns the pool of threads used to search the indexes of all folders at the same time, it is created only the first time
+    """
+    with RESOURCES_LOCK:
+        if "SEARCH_POOL" not in RESOURCES:
+            RESOURCES["SEARCH_POOL"] = ThreadPoolExecutor(max_workers=max(1,len(get_folders())))
+        return RESOURCES["SEARCH_POOL"]
+
+def warm_up():
+    """
+    Loads all the resources used by the queries (DB, vocabularies and Annoy indexes), meant to be called when a server is started
+    so the first query doesn't pay for it
+    """
+    get_docs_year()
+    get_db()
+    get_folders_files()
+    get_search_pool()
+    for folder in get_folders():
+        if os.path.exists(f"{ANNOY_IDXS_PATH}{folder}.ann"):
+            ann.get_annoy_index(f"{ANNOY_IDXS_PATH}{folder}.ann",266)
+
+def __getattr__(name : str):
+    # The module level names of the resources are still available (query_results_timeline.DB), but loaded on first use
+    getters = {"DB": get_db, "FOLDERS_FILES": get_folders_files, "FILE_YEAR": get_file_year, "SEARCH_POOL": get_search_pool,
+               "FOLDERS": get_folders, "DOCS_YEAR": get_docs_year}
+    if name in getters:
+        return getters[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_folder_word(current : int, item : int) -> str:
+    """
+    This function returns the word of an item found in the indexes of a folder, items after the ones of the main index belong to the delta index
+
+    Parameters:
+        current : integer
+            The position of the folder in FOLDERS
+        item : integer
+            The item found in the indexes of the folder
+    Returns:
+        word : string
+            The word of the item
+    """
+    folders_files = get_folders_files()
+    words_list = folders_files[current][0]
+    if item < len(words_list):
+        return words_list[item]
+    return folders_files[current][1][item-len(words_list)]
+
+def search_folder_indexes(current : int, q_vector : list[int], k : int) -> list[list[int],list[float]]:
+    """
+    This function searches the nearest neighbours of a descriptor in the main index of a folder and in its delta index if there is one
+
+    Parameters:
+        current : integer
+            The position of the folder in FOLDERS
+        q_vector : list of integers
+            The PHOC descriptor of the searched word
+        k : integer
+            The number of neighbours to return
+    Returns:
+        sv : list of lists of ints and floats
+            A pair of lists, the first one is a list of items and the second one a list of distances
+    """
+    folder = get_folders()[current]
+    folders_files = get_folders_files()
+    annoy_filename = f"{ANNOY_IDXS_PATH}{folder}.ann"
+    sv = [[],[]]
+    # A folder indexed only incrementally has a delta index but no main index yet
+    if os.path.exists(annoy_filename):
+        annoy_idx = ann.get_annoy_index(annoy_filename,266)
+        # The main index has grown if the delta index has been merged into it since its words were loaded
+        if annoy_idx.get_n_items() != len(folders_files[current][0]):
+            folders_files[current][0] = load_folder_words(folder)
+            folders_files[current][1] = []
+        sv = annoy_idx.get_nns_by_vector(q_vector, k, include_distances=True)
+    elif len(folders_files[current][0]) > 0:
+        # The main index has been removed since its words were loaded
+        folders_files[current][0] = []
+        folders_files[current][1] = []
+    delta_annoy_file,delta_words_file = ann.get_delta_filenames(folder)
+    if os.path.exists(delta_annoy_file):
+        delta_idx = ann.get_annoy_index(delta_annoy_file,266)
+        # The delta index only grows until it is merged, new words have been added if it has more items than loaded words
+        if delta_idx.get_n_items() != len(folders_files[current][1]):
+            folders_files[current][1] = fm.load_json(delta_words_file)
+        delta_sv = delta_idx.get_nns_by_vector(q_vector, k, include_distances=True)
+        # Merge both lists of neighbours, the items of the delta index go after the ones of the main index
+        n_main = len(folders_files[current][0])
+        merged = sorted(zip(sv[1]+delta_sv[1],sv[0]+[n_main+item for item in delta_sv[0]]))[:k]
+        sv = [[item for _,item in merged],[dist for dist,_ in merged]]
+    return sv
+
+def get_folders_nns(q_word : str, k : int) -> list[list[list[int],list[float]]]:
+    """
+    This function searches the nearest neighbours of a word in the indexes of all folders at the same time, using a pool of threads
+
+    The PHOC of the word is computed once and annoy releases the GIL while searching, so the time grows with the slowest folder
+
+    Parameters:
+        q_word : string
+            The searched word
+        k : integer
+            The number of neighbours to get from each folder
+    Returns:
+        svs : list of lists of ints and floats
+            A list containig pairs of lists for each folder, the first one is a list of items and the second one a list of distances
+    """
+    q_vector = phoc.PHOC(q_word,3)
+    return list(get_search_pool().map(lambda current: search_folder_indexes(current,q_vector,k),range(len(get_folders()))))
+
+def get_global_nns(q_word : str, k : int, th : float, folders : list[str]|None = None) -> list[tuple[float,str]]:
+    """
+    This function searches the nearest neighbours of a word in the global index, which has one vector per different word of all folders
+
+    If only some folders are requested, the neighbours that don't appear in any of them are discarded using the postings of the words,
+    and more neighbours are requested until there are k of them or the distances are over the threshold
+
+    Parameters:
+        q_word : string
+            The searched word
+        k : integer
+            The number of different words to return
+        th : float
+            The threshold by which a similar word is considered the same
+        folders : list of strings | None
+            The folders in which the neighbours must appear, None for all the folders
+    Returns:
+        neighbours : list of tuples of float and string
+            The distance and word of each neighbour under the threshold, ordered by ascending distance
+    """
+    global_index = get_global_index()
+    annoy_idx = global_index["index"]
+    q_vector = phoc.PHOC(q_word,3)
+    if folders is None:
+        items,dists = annoy_idx.get_nns_by_vector(q_vector, k, include_distances=True)
+        return [(dist,global_index["words"][item]) for item,dist in zip(items,dists) if dist <= th]
+    folders_mask = 0
+    for folder in folders:
+        if folder in global_index["folders"]:
+            folders_mask |= 1 << global_index["folders"].index(folder)
+    n = k
+    while True:
+        items,dists = annoy_idx.get_nns_by_vector(q_vector, n, include_distances=True)
+        kept = [(dist,item) for item,dist in zip(items,dists) if dist <= th and int(global_index["postings"][item]) & folders_mask]
+        # Stop when there are enough neighbours, the index has no more items or the last ones are already over the threshold
+        if len(kept) >= k or len(items) < n or dists[-1] > th:
+            return [(dist,global_index["words"][item]) for dist,item in kept[:k]]
+        n *= 2
 
-FILE_YEAR = {k: int(v) for k,v in fm.load_json(DOCS_YEARS_PATH).items()}
+def merge_folders_nns(svs : list[list[list[int],list[float]]], th : float, global_k : int|None = None) -> list[tuple[float,str]]:
+    """
+    This function merges the neighbours found in each folder, keeping the ones under the threshold ordered by distance
 
-def get_knn_docs_dates_bd(svs, th) -> tuple[list[int],list[str],list[str],dict]:
+    Parameters:
+        svs : list of lists of ints and floats
+            A list containig pairs of lists for each folder, the first one is a list of items and the second one a list of distances
+        th : float
+            The threshold by which a similar word is considered the same
+        global_k : integer | None
+            The maximum number of different words to keep among all folders, None to keep all the words under the threshold
+    Returns:
+        neighbours : list of tuples of float and string
+            The distance and word of each different neighbour, ordered by ascending distance
+    """
+    candidates = sorted((sv[1][i],get_folder_word(current,sv[0][i])) for current,sv in enumerate(svs) for i in range(len(sv[0])) if sv[1][i] <= th)
+    neighbours = []
+    words_found = set()
+    for dist,word in candidates:
+        # The same word can be found in many folders, only its closest instance is kept
+        if word not in words_found:
+            words_found.add(word)
+            neighbours.append((dist,word))
+    return neighbours if global_k is None else neighbours[:global_k]
+
+def get_knn_docs_dates_bd(svs, th, global_k=None, folders=None) -> tuple[np.ndarray,np.ndarray,set,set,dict]:
     """
     This function returns the dates of the bboxes in the files in which the neighbours of the word have been found
 
     Parameters:
         svs : list of lists of ints and floats
             A list containig pairs of lists, the first one is a list of indexs and the second one a list of distances
+        th : float
+            The threshold by which a similar word is considered the same
+        global_k : integer | None
+            The maximum number of different neighbours to consider among all folders, None to consider all the neighbours under the threshold
+        folders : list of strings | None
+            The folders in which to find the neighbours, None for all the folders
     Returns:
-        reps_dates : list of integers
-            A list containing the year of each file in which the word has been found
+        years : numpy array of integers
+            The years in which the neighbours have been found, in ascending order
+        reps_per_year : numpy array of integers
+            The number of times the neighbours have been found in each year
         reps_files : list of strings
             A list with the files in which the word has been found
         words_found : list of strings
@@ -46,69 +293,106 @@ def get_knn_docs_dates_bd(svs, th) -> tuple[list[int],list[str],list[str],dict]:
         sections : dictionary
             Dictionary containing all instances of bounding box in page in file where the word has been found
     """
-    # Get K nearest neighbours to the searched word
-    reps_dates = []
+    return get_neighbours_docs_dates_bd(merge_folders_nns(svs,th,global_k),folders)
+
+def get_neighbours_docs_dates_bd(neighbours : list[tuple[float,str]], folders : list[str]|None = None) -> tuple[np.ndarray,np.ndarray,set,set,dict]:
+    """
+    This function returns the dates of the bboxes in the files in which some neighbours have been found
+
+    Parameters:
+        neighbours : list of tuples of float and string
+            The distance and word of each neighbour
+        folders : list of strings | None
+            The folders in which to find the neighbours, None for all the folders
+    Returns:
+        The same values as get_knn_docs_dates_bd
+    """
     reps_files = set()
     sections = {}
-    # For each neighbour
-    #print(f"For word {searched}, it's {nn} nearest neighbours are:")
-    # Create a set to avoid double counting the same files
-    words_found = set()
-    for current,sv in enumerate(svs):
-        for i in range(len(sv[0])):
-            #print(f"\t{w_ls[sv[0][i]]}")
-            #print(f"distance = {sv[1][i]}")
-            if sv[1][i] <= th:
-                #print(f"word = {FOLDERS_FILES[current][0][sv[0][i]]}")
-                # If it hasn't been added yet
-                if FOLDERS_FILES[current][0][sv[0][i]] not in words_found:
-                    # Get the files it appears in
-                    tI = t.time()
-                    results = s.query_word(DB.cursor(),FOLDERS_FILES[current][0][sv[0][i]])
-                    results = results.fetchall()
-                    #print(f"Query results in {t.time()-tI}")
-                    #print(f"{len(results)} results")
-                    tF = 0
-                    for result in results:#tqdm(results):
-                        year = FILE_YEAR[result['file']]
-                        file_reps_year = [year]*result['total_words_reps']
-                        reps_dates += file_reps_year
-                        reps_files.add(result['file'])
-                        if result['file'] not in sections:
-                            sections[result['file']] = {result['page']: {result['bbox']: None}}
-                        elif result['page'] not in sections[result['file']]:
-                            sections[result['file']][result['page']] = {result['bbox']: None}
-                        elif result['bbox'] not in sections[result['file']][result['page']]:
-                            sections[result['file']][result['page']][result['bbox']] = None
-                    words_found.add(FOLDERS_FILES[current][0][sv[0][i]])
-    #print(f"Neighbours found a total of {len(reps_dates)} times")
+    words_found = set(word for _,word in neighbours)
+    # Get the files all the neighbours appear in with a single query
+    tI = t.time()
+    results = s.query_words(get_db().cursor(),list(words_found),folders)
+    #print(f"Query results in {t.time()-tI}")
+    #print(f"{len(results['file'])} results")
+    for file,page,bbox,total_words_reps in zip(results['file'],results['page'],results['bbox'],results['total_words_reps']):
+        reps_files.add(file)
+        if file not in sections:
+            sections[file] = {page: {bbox: None}}
+        elif page not in sections[file]:
+            sections[file][page] = {bbox: None}
+        elif bbox not in sections[file][page]:
+            sections[file][page][bbox] = None
+    # Get the number of repetitions per year directly from the DB
+    years,reps_per_year = s.get_words_years_histogram(get_db().cursor(),list(words_found),folders)
+    #print(f"Neighbours found a total of {sum(reps_per_year)} times")
     #print()
-    return reps_dates,reps_files,words_found,sections
+    return np.asarray(years,dtype=int),np.asarray(reps_per_year,dtype=int),reps_files,words_found,sections
 
-def show_stats_per_query_word(q_word,n_docs_year,k,th=THRESHOLD,save_files=True,normalized=True):
-    all_sv = []
+def get_years_histogram(years : list[int], reps : list[int]) -> tuple[np.ndarray,np.ndarray]:
+    """
+    This function adds the repetitions of the results of the same year
+
+    Parameters:
+        years : list of integers
+            The year of each result
+        reps : list of integers
+            The number of repetitions of each result
+    Returns:
+        hist_years : numpy array of integers
+            The different years of the results, in ascending order
+        reps_per_year : numpy array of integers
+            The number of repetitions in each year
+    """
+    hist_years,inverse = np.unique(np.asarray(years,dtype=int),return_inverse=True)
+    reps_per_year = np.bincount(inverse,weights=np.asarray(reps,dtype=float),minlength=len(hist_years)).astype(int)
+    return hist_years,reps_per_year
+
+def get_reps_per_year(years : np.ndarray, reps_per_year : np.ndarray, n_docs_year : dict, normalized : bool) -> tuple[OrderedDict,list[float]]:
+    """
+    This function returns the repetitions of every year with documents, normalized by the number of documents of the year if requested
+
+    Parameters:
+        years : numpy array of integers
+            The years in which the words have been found, in ascending order
+        reps_per_year : numpy array of integers
+            The number of times the words have been found in each year
+        n_docs_year : dictionary
+            A dictionary with the number of documents of each year
+        normalized : bool
+            Wether the repetitions are to be normalized by the number of documents or not
+    Returns:
+        n_docs_year : ordered dictionary
+            The number of documents of each year, ordered by year
+        reps : list of floats
+            The repetitions of each year of n_docs_year, 0 for the years in which the words haven't been found
+    """
+    n_docs_year = OrderedDict(sorted(n_docs_year.items()))
+    all_years = np.fromiter(n_docs_year.keys(),dtype=int,count=len(n_docs_year))
+    reps = np.zeros(len(all_years),dtype=float)
+    # Position of each year of the results among all the years
+    pos = np.searchsorted(all_years,years)
+    found = pos < len(all_years)
+    found[found] = all_years[pos[found]] == np.asarray(years)[found]
+    reps[pos[found]] = np.asarray(reps_per_year)[found]
+    if normalized:
+        reps /= np.fromiter(n_docs_year.values(),dtype=float,count=len(n_docs_year))
+    return n_docs_year,reps.tolist()
+
+def show_stats_per_query_word(q_word,n_docs_year,k,th=THRESHOLD,save_files=True,normalized=True,global_k=None,use_global_index=False,folders=None):
     qT = t.time()
-    for idx,folder in enumerate(FOLDERS):
-        ann_file = f"{PATH_TO_ANN_PHOC_FILES}/annoy_idxs_v2/{folder}.ann"
-        annoy_idx = ann.load_annoy_file(ann_file,266)
-        time = t.time()
-        all_sv.append(annoy_idx.get_nns_by_vector(phoc.PHOC(q_word,3), k, include_distances=True))
-        #print(f"{t.time()-time} to get {folder} nns")
-    #print(f"{t.time()-qT} to get all nns")
-    tI = t.time()
-    dates,found_in_files,words_found,sections = get_knn_docs_dates_bd(all_sv,th)
+    if use_global_index:
+        # One search in the global index, k is the number of different words instead of the number per folder
+        neighbours = get_global_nns(q_word,k if global_k is None else min(k,global_k),th,folders)
+        tI = t.time()
+        years,reps_per_year,found_in_files,words_found,sections = get_neighbours_docs_dates_bd(neighbours,folders)
+    else:
+        all_sv = get_folders_nns(q_word,k)
+        #print(f"{t.time()-qT} to get all nns")
+        tI = t.time()
+        years,reps_per_year,found_in_files,words_found,sections = get_knn_docs_dates_bd(all_sv,th,global_k,folders)
     #print(f"{t.time()-tI} to get dates")
-    years,reps_per_year = np.unique(dates,return_counts=True)
-    reps = []
-    n_docs_year = OrderedDict(sorted(n_docs_year.items()))
-    for year,n_docs in n_docs_year.items():
-        if year in years:
-            if normalized:
-                reps.append(reps_per_year[np.argwhere(years == year)[0]][0]/n_docs)
-            else:
-                reps.append(reps_per_year[np.argwhere(years == year)[0]][0])
-        else:
-            reps.append(float(0))
+    n_docs_year,reps = get_reps_per_year(years,reps_per_year,n_docs_year,normalized)
     if save_files:
         # This code is in case the current display is not liked
         """fig, ax = plt.subplots()
@@ -161,7 +445,23 @@ def get_common_sections(dict1 : dict, dict2 : dict) -> dict:
  
     return compare_dicts(dict1, dict2)
 
-def show_stats_per_query_word_combined(q_words_list : list[str], combination_type : str, n_docs_year : dict, k : int, th : float = THRESHOLD, save_files : bool = True, normalized : bool = True) -> tuple[matplotlib.figure.Figure,set] | tuple[list[int],list[float|int],set,list[tuple[str]]]:
+def get_documents_hrefs(files : list[str]) -> dict:
+    """
+    This function returns the link to the original document of each file, from the metadata of the documents in the DB if it has been built
+
+    Parameters:
+        files : list of strings
+            The files, relative to the OCR DB
+    Returns:
+        hrefs : dictionary
+            The link of each file
+    """
+    if s.documents_table_exists(get_db()):
+        metadata = s.get_documents_metadata(get_db().cursor(),files)
+        return {file: metadata[file]['href'] if file in metadata else fm.get_document_href(PATH_TO_OCR_DB+file) for file in files}
+    return {file: fm.get_document_href(PATH_TO_OCR_DB+file) for file in files}
+
+def show_stats_per_query_word_combined(q_words_list : list[str], combination_type : str, n_docs_year : dict, k : int, th : float = THRESHOLD, save_files : bool = True, normalized : bool = True, use_global_index : bool = False, folders : list[str]|None = None) -> tuple[matplotlib.figure.Figure,set] | tuple[list[int],list[float|int],set,list[tuple[str]]]:
     """
     This function takes a list of words and if they are combined or not, then finds the number of times the query appears in the documents
 
@@ -180,6 +480,10 @@ def show_stats_per_query_word_combined(q_words_list : list[str], combination_typ
             Wether to save the generated data in files or not, default to True
         normalized : bool
             Wether the repetitions results are to be normalized by the number of documents or not, default to True
+        use_global_index : bool
+            Wether to search the words in the global index instead of in the index of each folder, default to False
+        folders : list of strings | None
+            The folders in which to find the words, None for all the folders
     
     Returns:
         fig : matplotlib.pyplot figure
@@ -195,11 +499,11 @@ def show_stats_per_query_word_combined(q_words_list : list[str], combination_typ
 
     """
     # Get the sections for the first word
-    _,_,found_in_i,related_words_i,sections_i = show_stats_per_query_word(q_words_list[0],n_docs_year,k,th,False,False)
+    _,_,found_in_i,related_words_i,sections_i = show_stats_per_query_word(q_words_list[0],n_docs_year,k,th,False,False,None,use_global_index,folders)
     assert len(found_in_i & sections_i.keys()) == len(found_in_i) == len(sections_i.keys())
     # If there are more words, get their sections and combine with the first one depending on the combination type
     for word in tqdm(q_words_list[1:],f"getting {combination_type} results"):
-        _,_,found_in,related_words,sections = show_stats_per_query_word(word,n_docs_year,k,th,False,False)
+        _,_,found_in,related_words,sections = show_stats_per_query_word(word,n_docs_year,k,th,False,False,None,use_global_index,folders)
         assert len(found_in & sections.keys()) == len(found_in) == len(sections.keys())
         if combination_type == "AND":
             found_in_i &= found_in
@@ -220,35 +524,23 @@ def show_stats_per_query_word_combined(q_words_list : list[str], combination_typ
                 #print(bbox)
                 sections_to_find.append((file,page,bbox))
     if combination_type == "AND":
-        res = s.get_n_reps_from_sections_list(DB.cursor(),sections_to_find,list(related_words_i))
+        res = s.get_n_reps_from_sections_list(get_db().cursor(),sections_to_find,list(related_words_i))
     else:
-        res = s.get_n_reps_from_files_list(DB.cursor(),list(found_in_i),list(related_words_i))
+        res = s.get_n_reps_from_files_list(get_db().cursor(),list(found_in_i),list(related_words_i))
     res = res
     print(len(found_in_i))
     print(len(res))
-    reps_dates = []
     combined_sections = {}
-    for result in tqdm(res,"Getting years for each file"):
-        year = FILE_YEAR[result['file']]# This should be changed to use the year column of the DB
-        file_reps_year = [year]*result['total_words_reps']
-        reps_dates += file_reps_year
+    hrefs = get_documents_hrefs(list(set(result['file'] for result in res)))
+    for result in tqdm(res,"Getting sections of each file"):
         if result['file'] not in combined_sections:
-            combined_sections[result['file']] = {result['page']: {result['bbox']: ["https://boe.es"+json.load(open(PATH_TO_OCR_DB+result['file'],'r'))['document_href'],result['total_words_reps']]}}
+            combined_sections[result['file']] = {result['page']: {result['bbox']: ["https://boe.es"+hrefs[result['file']],result['total_words_reps']]}}
         elif result['page'] not in combined_sections[result['file']]:
-            combined_sections[result['file']][result['page']] = {result['bbox']: ["https://boe.es"+json.load(open(PATH_TO_OCR_DB+result['file'],'r'))['document_href'],result['total_words_reps']]}
+            combined_sections[result['file']][result['page']] = {result['bbox']: ["https://boe.es"+hrefs[result['file']],result['total_words_reps']]}
         elif result['bbox'] not in combined_sections[result['file']][result['page']]:
-            combined_sections[result['file']][result['page']][result['bbox']] = ["https://boe.es"+json.load(open(PATH_TO_OCR_DB+result['file'],'r'))['document_href'],result['total_words_reps']]
-    years,reps_per_year = np.unique(reps_dates,return_counts=True)
-    reps = []
-    n_docs_year = OrderedDict(sorted(n_docs_year.items()))
-    for year,n_docs in tqdm(n_docs_year.items(),"Calculating plot values"):
-        if year in years:
-            if normalized:
-                reps.append(reps_per_year[np.argwhere(years == year)[0]][0]/n_docs)
-            else:
-                reps.append(reps_per_year[np.argwhere(years == year)[0]][0])
-        else:
-            reps.append(float(0))
+            combined_sections[result['file']][result['page']][result['bbox']] = ["https://boe.es"+hrefs[result['file']],result['total_words_reps']]
+    years,reps_per_year = get_years_histogram([result['file_year'] for result in res],[result['total_words_reps'] for result in res])
+    n_docs_year,reps = get_reps_per_year(years,reps_per_year,n_docs_year,normalized)
 
     if save_files:
         # This code is in case the current display is not liked
@@ -277,8 +569,8 @@ def show_stats_per_query_word_combined(q_words_list : list[str], combination_typ
         return years,reps,found_in_i,sections_to_find
 
 if __name__ == "__main__":
-    years,reps,found_in_files,words_found,sections = show_stats_per_query_word("Agua",DOCS_YEAR,10,0.4,False,False)
-    """_,_, = show_stats_per_query_word_combined(["fiebre","amarilla"],'AND',DOCS_YEAR,10,THRESHOLD,True,True)
-    _,_, = show_stats_per_query_word_combined(["peste"],'',DOCS_YEAR,10,THRESHOLD,True,True)
-    _,_, = show_stats_per_query_word_combined(["colera"],'',DOCS_YEAR,10,THRESHOLD,True,True)
-    _,_, = show_stats_per_query_word_combined(["gripe"],'',DOCS_YEAR,10,THRESHOLD,True,True)"""
+    years,reps,found_in_files,words_found,sections = show_stats_per_query_word("Agua",get_docs_year(),10,0.4,False,False)
+    """_,_, = show_stats_per_query_word_combined(["fiebre","amarilla"],'AND',get_docs_year(),10,THRESHOLD,True,True)
+    _,_, = show_stats_per_query_word_combined(["peste"],'',get_docs_year(),10,THRESHOLD,True,True)
+    _,_, = show_stats_per_query_word_combined(["colera"],'',get_docs_year(),10,THRESHOLD,True,True)
+    _,_, = show_stats_per_query_word_combined(["gripe"],'',get_docs_year(),10,THRESHOLD,True,True)"""
@@ -1,28 +1,159 @@
-# pip install -U sentence-transformers
-from sentence_transformers import SentenceTransformer,CrossEncoder,util
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from annoy import AnnoyIndex
 import file_manager as fm
 import time_manager as tm
+import phoc_annoy as ann
 from tqdm import tqdm
 from common import *
 import numpy as np
+import threading
 import time as t
-import torch
+import heapq
 import os
 
-def check_cuda():
+# torch and sentence_transformers are imported by the functions that use them, so importing this module doesn't load them
+if TYPE_CHECKING:
+    # pip install -U sentence-transformers
+    from sentence_transformers import SentenceTransformer,CrossEncoder
+
+# Number of embeddings compared with the query at once when searching on CPU
+SEARCH_BLOCK_SIZE = 65536
+# Number of trees of the annoy indexes over the embeddings
+SBERT_N_TREES = 50
+
+# Float32 tensors in a device of the memory-mapped embeddings, converted once per file and device
+DEVICE_EMBEDDINGS = {}
+DEVICE_EMBEDDINGS_LOCK = threading.Lock()
+
+def get_device_embeddings(embedd : np.ndarray, device : str):
+    """
+    Returns the embeddings as a float32 tensor in a device, the embeddings of a store are converted and copied to the device only the first
+    time and again if the file of the store changes
+
+    Parameters:
+        embedd: numpy array
+            A matrix containing all embeddings of all sentences, memory-mapped if it comes from a store
+        device: string
+            The device of the tensor
+    Returns:
+        tensor: tensor
+            The embeddings in the device
+    """
+    import torch
+    filename = getattr(embedd,"filename",None)
+    if filename is None:
+        # Not a memory-mapped store, there is no file to identify it by
+        return torch.from_numpy(np.array(embedd,dtype=np.float32)).to(device)
+    key = (filename,device)
+    mtime = os.path.getmtime(filename)
+    with DEVICE_EMBEDDINGS_LOCK:
+        if key in DEVICE_EMBEDDINGS and DEVICE_EMBEDDINGS[key][1] == mtime:
+            return DEVICE_EMBEDDINGS[key][0]
+        # The old tensor is dropped before converting the new one, so both don't need to fit in the device
+        DEVICE_EMBEDDINGS.pop(key,None)
+        tensor = torch.from_numpy(np.array(embedd,dtype=np.float32)).to(device)
+        DEVICE_EMBEDDINGS[key] = (tensor,mtime)
+        return tensor
+
+def check_cuda() -> bool:
     """
-    This function makes sure that cuda is available when the program is started, if not, it will throw an error
+    This function checks if cuda is available, if not, the searches are done on CPU
+
+    Returns:
+        available: bool
+            If cuda is available
     """
+    import torch
     if not torch.cuda.is_available():
-        print("No GPU, program won't start")
-        assert(torch.cuda.is_available() == True)
+        print("No GPU, searching on CPU")
+        return False
     else:
         print("Current available devices:")
         for d_id in range(torch.cuda.device_count()):
             print(f"\t{torch.cuda.get_device_name(d_id)} with id: {d_id}")
         print(f"Working with device: {torch.cuda.get_device_name(torch.cuda.current_device())}")
+        return True
+
+def get_device() -> str:
+    """
+    Returns the device in which the searches are done, cuda if it is available and cpu otherwise
+    """
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def search_block(q_embbs : np.ndarray, embedd : np.ndarray, start : int, end : int, top_k : int) -> tuple[np.ndarray,np.ndarray]:
+    """
+    Compares the normalized queries with a block of the embeddings and keeps the top_k most similar of the block for each query
 
-check_cuda()
+    Parameters:
+        q_embbs: numpy array
+            The normalized embeddings of the queries, one per row
+        embedd: numpy array
+            A matrix containing all embeddings of all sentences
+        start: integer
+            The first row of the block
+        end: integer
+            The row after the last one of the block
+        top_k: integer
+            The number of results to keep for each query
+    Returns:
+        ids: numpy array of integers
+            The rows of the best results of each query, not ordered
+        scores: numpy array of floats
+            The cosine similarity of each result
+    """
+    block = np.asarray(embedd[start:end],dtype=np.float32)
+    norms = np.linalg.norm(block,axis=1)
+    norms[norms == 0] = 1
+    scores = (q_embbs @ block.T) / norms
+    if top_k < scores.shape[1]:
+        ids = np.argpartition(-scores,top_k-1,axis=1)[:,:top_k]
+        scores = np.take_along_axis(scores,ids,axis=1)
+    else:
+        ids = np.broadcast_to(np.arange(scores.shape[1]),scores.shape)
+    return ids+start,scores
+
+def cpu_semantic_search(q_embbs, embedd, top_k : int, block_size : int = SEARCH_BLOCK_SIZE, n_workers : int = os.cpu_count()) -> list[list[dict]]:
+    """
+    Semantic search on CPU: the cosine similarity of the queries with blocks of the embeddings is computed by a pool of threads
+    (numpy releases the GIL while multiplying matrices), the top_k of each block are selected with argpartition and then merged
+
+    Parameters:
+        q_embbs: numpy array
+            The embedding of a query or a matrix with the embedding of each query
+        embedd: numpy array
+            A matrix containing all embeddings of all sentences, it can be memory-mapped and float16
+        top_k: integer
+            The number of results to return for each query
+        block_size: integer
+            The number of embeddings compared at once, it limits the memory used by each thread
+        n_workers: integer
+            The number of threads
+    Returns:
+        res: list of lists of dictionaries
+            For each query, its results ordered by descending score, like util.semantic_search: {'corpus_id': row, 'score': cosine similarity}
+    """
+    q_embbs = np.atleast_2d(np.asarray(q_embbs,dtype=np.float32))
+    q_norms = np.linalg.norm(q_embbs,axis=1,keepdims=True)
+    q_norms[q_norms == 0] = 1
+    q_embbs = q_embbs/q_norms
+    blocks = [(start,min(start+block_size,len(embedd))) for start in range(0,len(embedd),block_size)]
+    if len(blocks) == 0 or top_k <= 0:
+        return [[] for _ in range(len(q_embbs))]
+    with ThreadPoolExecutor(max_workers=max(1,min(n_workers,len(blocks)))) as pool:
+        partial = list(pool.map(lambda block: search_block(q_embbs,embedd,block[0],block[1],top_k),blocks))
+    ids = np.concatenate([block_ids for block_ids,_ in partial],axis=1)
+    scores = np.concatenate([block_scores for _,block_scores in partial],axis=1)
+    res = []
+    for q_ids,q_scores in zip(ids,scores):
+        if top_k < len(q_scores):
+            best = np.argpartition(-q_scores,top_k-1)[:top_k]
+        else:
+            best = np.arange(len(q_scores))
+        best = best[np.argsort(-q_scores[best],kind='stable')]
+        res.append([{'corpus_id': int(q_ids[i]), 'score': float(q_scores[i])} for i in best])
+    return res
 
 def gen_files(model,model_name,folder):
     # Get al bboxs from all files
@@ -46,23 +177,226 @@ def gen_files(model,model_name,folder):
 
     return bbox_idx_to_file_list,sentences,embeddings
 
-def get_files(model_name : str, folder : str):
+def get_store_prefix(model_name : str, folder : str) -> str:
+    """
+    Returns the path, without extension, of the embeddings store of a folder
     """
-    This function returns the pre-created files needed when using sentence transformers's semantic search
+    return f"{PATH_TO_SBERT_FILES}/{'_'.join(model_name.split('/'))}/{folder}_store"
+
+def save_embeddings_store(embeddings, sentences : list[str], bbox_idx_to_file_list : list[str], prefix : str, use_float16 : bool = True):
+    """
+    Saves the files needed when using semantic search in a format that can be memory-mapped:
+       · The embeddings as a matrix -> prefix_embeddings.npy
+       · The sentences as a single UTF-8 buffer with offsets -> prefix_sentences.bin, prefix_sentences_offsets.npy
+       · The different files as a single UTF-8 buffer with offsets -> prefix_files.bin, prefix_files_offsets.npy
+       · The position of the file of each sentence among the different files -> prefix_bbox_files.npy
 
     Parameters:
-        model_name: string
-            The name of the model being used
-        folder: string
-            The name of the folder used when the files were created
+        embeddings: tensor or numpy array
+            A matrix containing the embedding of each sentence
+        sentences: list of strings
+            The text that has been used to create the embedding of the same position
+        bbox_idx_to_file_list: list of strings
+            To which file correspond the same position in the sentences list
+        prefix: string
+            Path to where the store is going to be saved, without extension
+        use_float16: bool
+            If the embeddings are saved as float16, which halves their size
+    """
+    if not isinstance(embeddings,np.ndarray):
+        embeddings = embeddings.cpu().numpy()
+    fm.save_strings(sentences,f"{prefix}_sentences")
+    np.save(f"{prefix}_embeddings.npy",np.ascontiguousarray(embeddings,dtype=np.float16 if use_float16 else np.float32))
+    files_pos = {}
+    bbox_files = np.fromiter((files_pos.setdefault(file,len(files_pos)) for file in bbox_idx_to_file_list),dtype=np.int32,count=len(bbox_idx_to_file_list))
+    fm.save_strings(files_pos.keys(),f"{prefix}_files")
+    np.save(f"{prefix}_bbox_files.npy",bbox_files)
+
+class BboxFiles:
+    """
+    Read-only list with the file of each sentence of an embeddings store, the file names are memory-mapped
+    """
+    def __init__(self, prefix : str):
+        self.files = fm.MappedStrings(f"{prefix}_files")
+        self.bbox_files = np.load(f"{prefix}_bbox_files.npy",mmap_mode='r')
+        self.files_pos = None
+
+    def __len__(self) -> int:
+        return len(self.bbox_files)
+
+    def __getitem__(self, idx):
+        if isinstance(idx,slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return self.files[int(self.bbox_files[idx])]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def index(self, file : str) -> int:
+        """
+        Returns the position of the first sentence of a file, like list.index
+        """
+        if self.files_pos is None:
+            self.files_pos = {name: pos for pos,name in enumerate(self.files)}
+        if file in self.files_pos:
+            found = np.flatnonzero(self.bbox_files == self.files_pos[file])
+            if len(found) > 0:
+                return int(found[0])
+        raise ValueError(f"{file!r} is not in the list")
+
+def load_embeddings_store(prefix : str):
+    """
+    Loads an embeddings store saved with save_embeddings_store, nothing is read until it is used
+
+    Parameters:
+        prefix: string
+            Path to the store, without extension
     Returns:
-        bbox_idx_to_file_list: list of string
+        bbox_idx_to_file_list: BboxFiles
             To which file correspond the same position in the sentences list
-        b_e_dict['bbox']: list of string
+        sentences: MappedStrings
             The text that has been used to create the embedding of the same position
-        b_e_dict['embeddings']: tensor
+        embeddings: numpy memmap
             A matrix containing the embedding of each sentence
     """
+    return BboxFiles(prefix),fm.MappedStrings(f"{prefix}_sentences"),np.load(f"{prefix}_embeddings.npy",mmap_mode='r')
+
+def convert_files(model_name : str, use_float16 : bool = True):
+    """
+    Converts the pickled files of all folders into embeddings stores
+    """
+    for folder in get_folders():
+        tI = t.time()
+        bbox_idx_to_file_list,sentences,embeddings = get_pickled_files(model_name,folder)
+        save_embeddings_store(embeddings,sentences,bbox_idx_to_file_list,get_store_prefix(model_name,folder),use_float16)
+        print(f"{folder} converted in {t.time()-tI}")
+
+def get_ann_filename(model_name : str, folder : str) -> str:
+    """
+    Returns the path of the annoy index over the embeddings of a folder
+    """
+    return f"{get_store_prefix(model_name,folder)}.ann"
+
+def build_ann_index(model_name : str, folder : str, n_trees : int = SBERT_N_TREES, n_jobs : int = -1, chunk_size : int = 100000):
+    """
+    Builds an annoy index over the embeddings of a folder, with the angular distance the results are the same as with cosine similarity
+    The index is built on disk, so the embeddings don't need to fit in memory
+
+    Parameters:
+        model_name: string
+            The name of the model being used
+        folder: string
+            The name of the folder
+        n_trees: integer
+            The number of trees of the index, more trees give a better recall but a bigger index that takes longer to build
+        n_jobs: integer
+            The number of threads used to build the trees, -1 to use all the cores
+        chunk_size: integer
+            The number of embeddings converted to float32 at once
+    """
+    tI = t.time()
+    _,_,embeddings = get_files(model_name,folder)
+    if not isinstance(embeddings,np.ndarray):
+        embeddings = embeddings.cpu().numpy()
+    ann_filename = get_ann_filename(model_name,folder)
+    ann_idx = AnnoyIndex(embeddings.shape[1], 'angular')
+    # Build in a temporary file and replace the old one, so processes using the old index can keep doing it
+    ann_idx.on_disk_build(ann_filename+".tmp")
+    for start in tqdm(range(0,len(embeddings),chunk_size),'embeddings'):
+        chunk = np.asarray(embeddings[start:start+chunk_size],dtype=np.float32)
+        for i,vector in enumerate(chunk):
+            ann_idx.add_item(start+i,vector)
+    ann_idx.build(n_trees,n_jobs=n_jobs)
+    ann_idx.unload()
+    os.replace(ann_filename+".tmp",ann_filename)
+    print(f"{folder} index with {len(embeddings)} embeddings built in {t.time()-tI}")
+
+def build_ann_indexes(model_name : str, n_trees : int = SBERT_N_TREES, n_jobs : int = -1):
+    """
+    Builds the annoy indexes over the embeddings of all folders
+    """
+    for folder in get_folders():
+        build_ann_index(model_name,folder,n_trees,n_jobs)
+
+def ann_semantic_search(q_embbs, ann_idx : AnnoyIndex, top_k : int, search_k : int = -1) -> list[list[dict]]:
+    """
+    Approximate semantic search with an annoy index built with build_ann_index
+
+    Parameters:
+        q_embbs: numpy array
+            The embedding of a query or a matrix with the embedding of each query
+        ann_idx: AnnoyIndex
+            The loaded index
+        top_k: integer
+            The number of results to return for each query
+        search_k: integer
+            The number of nodes inspected in the search, more nodes give a better recall but a slower search, -1 for n_trees*top_k
+    Returns:
+        res: list of lists of dictionaries
+            For each query, its results ordered by descending score, like util.semantic_search: {'corpus_id': row, 'score': cosine similarity}
+    """
+    res = []
+    for q_embb in np.atleast_2d(np.asarray(q_embbs,dtype=np.float32)):
+        ids,dists = ann_idx.get_nns_by_vector(q_embb,top_k,search_k=search_k,include_distances=True)
+        # The angular distance of annoy is the euclidean distance of the normalized vectors, sqrt(2-2*cos)
+        res.append([{'corpus_id': corpus_id, 'score': 1-dist*dist/2} for corpus_id,dist in zip(ids,dists)])
+    return res
+
+def benchmark_ann_recall(model_name : str, folder : str, k : int = 10, search_ks : tuple[int] = (-1,1000,10000,100000), n_queries : int = 100,
+                         q_embbs : np.ndarray|None = None) -> dict:
+    """
+    Measures the recall@k and the time per query of the annoy index of a folder against the exhaustive search
+    The queries should be held out from the corpus (e.g. encoded queries), if none are given random embeddings of the folder are used and
+    each one is removed from its own results, otherwise every query would find itself first and the recall would be inflated
+
+    Parameters:
+        model_name: string
+            The name of the model being used
+        folder: string
+            The name of the folder
+        k: integer
+            The number of results of each query
+        search_ks: tuple of integers
+            The values of search_k to measure
+        n_queries: integer
+            The number of random embeddings of the folder used as queries when no queries are given
+        q_embbs: numpy array | None
+            The embeddings of held-out queries, one per row, None to use embeddings of the folder
+    Returns:
+        results: dictionary
+            For each search_k, the recall@k and the milliseconds per query, plus the milliseconds per query of the exhaustive search
+    """
+    _,_,embeddings = get_files(model_name,folder)
+    if not isinstance(embeddings,np.ndarray):
+        embeddings = embeddings.cpu().numpy()
+    if q_embbs is None:
+        own_ids = np.sort(np.random.default_rng(0).choice(len(embeddings),min(n_queries,len(embeddings)),replace=False))
+        q_embbs = np.asarray(embeddings[own_ids],dtype=np.float32)
+        # One more result is requested so there are still k after removing the query itself
+        n_search = k+1
+    else:
+        own_ids = np.full(len(q_embbs),-1)
+        n_search = k
+    def remove_own(res):
+        return [[r for r in q_res if r['corpus_id'] != own_id][:k] for q_res,own_id in zip(res,own_ids)]
+    tI = t.time()
+    exact = remove_own(cpu_semantic_search(q_embbs,embeddings,n_search))
+    results = {"exhaustive_ms": (t.time()-tI)*1000/len(q_embbs)}
+    ann_idx = ann.get_annoy_index(get_ann_filename(model_name,folder),embeddings.shape[1])
+    for search_k in search_ks:
+        tI = t.time()
+        approx = remove_own(ann_semantic_search(q_embbs,ann_idx,n_search,search_k))
+        elapsed = (t.time()-tI)*1000/len(q_embbs)
+        found = sum(len({r['corpus_id'] for r in e} & {r['corpus_id'] for r in a}) for e,a in zip(exact,approx))
+        results[search_k] = {"recall": found/sum(len(e) for e in exact), "ms": elapsed}
+        print(f"search_k={search_k}: recall@{k} {results[search_k]['recall']:.4f}, {elapsed:.2f} ms per query (exhaustive {results['exhaustive_ms']:.2f} ms)")
+    return results
+
+def get_pickled_files(model_name : str, folder : str):
+    """
+    This function returns the pre-created pickled files needed when using sentence transformers's semantic search
+    """
     # Declare filenames to load
     files_filename = f"{PATH_TO_SBERT_FILES}/bbox_2_file/{folder}_files_ms.pickle"
     embedd_filename = f"{PATH_TO_SBERT_FILES}/{'_'.join(model_name.split('/'))}/{folder}_embeddings_ms.pickle"
@@ -72,8 +406,32 @@ def get_files(model_name : str, folder : str):
     # Return loaded data from files
     return bbox_idx_to_file_list,b_e_dict['bbox'],b_e_dict['embeddings']
 
-def search_query(query : str, bi_enc : SentenceTransformer, embedd, n_results : int, texts : list[str], bbox_2_file : list[str], cross_encode : bool,
-                 x_enc : CrossEncoder|None, top_n_results : int, show_res : bool):
+def get_files(model_name : str, folder : str):
+    """
+    This function returns the pre-created files needed when using sentence transformers's semantic search, from the embeddings store
+    of the folder if it has been created and from the pickled files otherwise
+
+    Parameters:
+        model_name: string
+            The name of the model being used
+        folder: string
+            The name of the folder used when the files were created
+    Returns:
+        bbox_idx_to_file_list: list of string
+            To which file correspond the same position in the sentences list
+        sentences: list of string
+            The text that has been used to create the embedding of the same position
+        embeddings: tensor or numpy array
+            A matrix containing the embedding of each sentence, memory-mapped if it comes from the store
+    """
+    prefix = get_store_prefix(model_name,folder)
+    if os.path.exists(f"{prefix}_embeddings.npy"):
+        return load_embeddings_store(prefix)
+    return get_pickled_files(model_name,folder)
+
+def search_query(query : str, bi_enc : "SentenceTransformer", embedd, n_results : int, texts : list[str], bbox_2_file : list[str], cross_encode : bool,
+                 x_enc : "CrossEncoder|None", top_n_results : int, show_res : bool, device : str|None = None, block_size : int = SEARCH_BLOCK_SIZE,
+                 ann_idx : AnnoyIndex|None = None, search_k : int = -1, return_ids : bool = False):
     """
     Given a query and the requiered parameters, this function returns a list of files and a list of scores for the given query's results
 
@@ -82,8 +440,8 @@ def search_query(query : str, bi_enc : SentenceTransformer, embedd, n_results :
                 The query to be searched
             bi_enc: SentenceTransformer object
                 The loaded bi-encoder model
-            embedd: Pytorch tensor, already loaded from previosly generated files
-                A tensor containing all embeddings of all sentences
+            embedd: Pytorch tensor or numpy array, already loaded from previosly generated files
+                A matrix containing all embeddings of all sentences
             n_results: integer
                 The number of results to get from semantic search
             texts: list of strings
@@ -98,20 +456,49 @@ def search_query(query : str, bi_enc : SentenceTransformer, embedd, n_results :
                 The number of results to return
             show_res: bool
                 If results are to be shown
+            device: string | None
+                The device in which the search is done (cuda or cpu), None to use cuda if it is available
+            block_size: integer
+                The number of embeddings compared at once when searching on CPU
+            ann_idx: AnnoyIndex | None
+                The annoy index over the embeddings, if given the search is approximate and done with it
+            search_k: integer
+                The number of nodes inspected in the annoy search, -1 for the default of annoy
+            return_ids: bool
+                If the position of each result in the embeddings (corpus_id) is to be returned too
     Returns:
             ret_files: list of strings
                 Resulting files from semantic search, ordered by ascending score
             ret_scores: list of floats
                 Resulting scores from semantic search, ordered by ascending score
+            ret_ids: list of integers
+                The position of each result in the embeddings, sentences and files, only returned if return_ids is True
     """
-    # Create the embedding of the query
-    q_embb = bi_enc.encode(query,convert_to_tensor=True)
-    # Make sure that all inputs are in the same device
-    embedd.cuda()
-    q_embb = q_embb.cuda()
-    # Compare the query embedding with the sentences embedding (semantic search)
+    if device is None:
+        device = get_device()
     tI = t.process_time()
-    res = util.semantic_search(q_embb,embedd,top_k=n_results)
+    if ann_idx is not None:
+        # Approximate search, the embeddings are not read
+        q_embb = bi_enc.encode(query,convert_to_numpy=True)
+        res = ann_semantic_search(q_embb,ann_idx,n_results,search_k)
+    elif device == "cpu":
+        # Create the embedding of the query and compare it with the sentences embedding on CPU
+        q_embb = bi_enc.encode(query,convert_to_numpy=True)
+        if not isinstance(embedd,np.ndarray):
+            embedd = embedd.cpu().numpy()
+        res = cpu_semantic_search(q_embb,embedd,n_results,block_size)
+    else:
+        # Create the embedding of the query
+        q_embb = bi_enc.encode(query,convert_to_tensor=True)
+        # The embeddings of a store are a numpy matrix (maybe float16), semantic search needs a float32 tensor
+        if isinstance(embedd,np.ndarray):
+            embedd = get_device_embeddings(embedd,"cuda")
+        # Make sure that all inputs are in the same device
+        embedd.cuda()
+        q_embb = q_embb.cuda()
+        # Compare the query embedding with the sentences embedding (semantic search)
+        from sentence_transformers import util
+        res = util.semantic_search(q_embb,embedd,top_k=n_results)
     ord_res = res[0]
 
     if cross_encode:
@@ -132,40 +519,158 @@ def search_query(query : str, bi_enc : SentenceTransformer, embedd, n_results :
         # Prepare return structures
         ret_files = []
         ret_scores = []
+        ret_ids = []
         for i in range(len(ord_res)):
             ret_files.append(bbox_2_file[ord_res[i]['corpus_id']])
             ret_scores.append(ord_res[i]['cross-score'])
-        return ret_files,ret_scores
+            ret_ids.append(ord_res[i]['corpus_id'])
     else:
         ret_files = []
         ret_scores = []
-        for i in range(top_n_results):
+        ret_ids = []
+        # The annoy search can return less results than requested
+        for i in range(min(top_n_results,len(ord_res))):
             ret_files.append(bbox_2_file[ord_res[i]['corpus_id']])
             ret_scores.append(ord_res[i]['score'])
-        return ret_files,ret_scores
+            ret_ids.append(ord_res[i]['corpus_id'])
+    if return_ids:
+        return ret_files,ret_scores,ret_ids
+    return ret_files,ret_scores
 
 BIENCODER_NAME = "sentence-transformers/distiluse-base-multilingual-cased-v1"
 
+# Files, sentences and embeddings of each folder, loaded the first time each folder is searched
 FOLDER_FILES_CONTENT_EMBEDDS = {}
-for folder in FOLDERS:
+CUDA_CHECKED = False
+
+def get_folder_files_content_embedds(folder : str) -> dict:
+    """
+    Returns the files, sentences and embeddings of a folder, they are loaded only the first time
+    """
+    if folder not in FOLDER_FILES_CONTENT_EMBEDDS:
         file_2_embedd,sentences,embedds = get_files(BIENCODER_NAME,folder)
         FOLDER_FILES_CONTENT_EMBEDDS[folder] = {"files":file_2_embedd,"sentences":sentences,"embedds":embedds}
+    return FOLDER_FILES_CONTENT_EMBEDDS[folder]
+
+def get_folder_ann_index(folder : str) -> AnnoyIndex:
+    """
+    Returns the annoy index over the embeddings of a folder, it is memory-mapped the first time
+    """
+    return ann.get_annoy_index(get_ann_filename(BIENCODER_NAME,folder),get_folder_files_content_embedds(folder)["embedds"].shape[1])
+
+def check_cuda_once():
+    """
+    Checks if cuda is available the first time a search needs it, instead of when the module is imported
+    """
+    global CUDA_CHECKED
+    if not CUDA_CHECKED:
+        check_cuda()
+        CUDA_CHECKED = True
 
-def search_query_in_all_folders(query,bi_enc,n_res):
+def warm_up():
+    """
+    Checks cuda and loads the files of all folders, meant to be called when a server is started so the first query doesn't pay for it
+    """
+    check_cuda_once()
+    for folder in get_folders():
+        get_folder_files_content_embedds(folder)
+
+def search_query_in_all_folders(query,bi_enc,n_res,use_ann=False,search_k=-1,return_ids=False):
     #bi_enc = SentenceTransformer(bi_enc)
-    results_files = []
-    results_sentences = []
-    results_scores = []
-    for folder in tqdm(FOLDERS):
-        folder_results_files,folder_results_scores = search_query(query,bi_enc,FOLDER_FILES_CONTENT_EMBEDDS[folder]["embedds"],n_res,FOLDER_FILES_CONTENT_EMBEDDS[folder]["sentences"],FOLDER_FILES_CONTENT_EMBEDDS[folder]["files"],False,None,n_res,False)
-        results_files+=folder_results_files
-        results_sentences+=[FOLDER_FILES_CONTENT_EMBEDDS[folder]["sentences"][FOLDER_FILES_CONTENT_EMBEDDS[folder]["files"].index(file)] for file in folder_results_files]
-        results_scores+=folder_results_scores
-    np_files = np.asarray(results_files)
-    np_sentences = np.asarray(results_sentences)
-    np_scores = np.asarray(results_scores)
-    sorted_idx = np_scores.argsort()[::-1]
-    np_files = np_files[sorted_idx]
-    np_sentences = np_sentences[sorted_idx]
-    np_scores = np_scores[sorted_idx]
-    return np_files[:n_res],np_scores[:n_res],np_sentences[:n_res]
\ No newline at end of file
+    # Score, folder and position in the embeddings of the folder of each result, the sentence and file are taken directly with the position
+    candidates = []
+    check_cuda_once()
+    for folder in tqdm(get_folders()):
+        folder_data = get_folder_files_content_embedds(folder)
+        ann_idx = get_folder_ann_index(folder) if use_ann else None
+        _,folder_results_scores,folder_results_ids = search_query(query,bi_enc,folder_data["embedds"],n_res,folder_data["sentences"],folder_data["files"],False,None,n_res,False,
+                                                                  ann_idx=ann_idx,search_k=search_k,return_ids=True)
+        candidates += [(score,folder,corpus_id) for score,corpus_id in zip(folder_results_scores,folder_results_ids)]
+    best = heapq.nlargest(n_res,candidates,key=lambda candidate: candidate[0])
+    np_files = np.asarray([get_folder_files_content_embedds(folder)["files"][corpus_id] for _,folder,corpus_id in best])
+    np_scores = np.asarray([score for score,_,_ in best])
+    np_sentences = np.asarray([get_folder_files_content_embedds(folder)["sentences"][corpus_id] for _,folder,corpus_id in best])
+    if return_ids:
+        return np_files,np_scores,np_sentences,[(folder,corpus_id) for _,folder,corpus_id in best]
+    return np_files,np_scores,np_sentences
+
+def semantic_search_embeddings(q_embbs : np.ndarray, embedd, top_k : int, device : str, block_size : int = SEARCH_BLOCK_SIZE,
+                               ann_idx : AnnoyIndex|None = None, search_k : int = -1) -> list[list[dict]]:
+    """
+    Searches the embeddings of many queries at once in the embeddings of a folder, with the annoy index if it is given and with a single
+    matrix product in the requested device otherwise
+
+    Parameters:
+        q_embbs: numpy array
+            The embedding of each query, one per row
+        embedd: tensor or numpy array
+            A matrix containing all embeddings of all sentences
+        top_k: integer
+            The number of results to return for each query
+        device: string
+            The device in which the search is done (cuda or cpu)
+        block_size: integer
+            The number of embeddings compared at once when searching on CPU
+        ann_idx: AnnoyIndex | None
+            The annoy index over the embeddings, if given the search is approximate and done with it
+        search_k: integer
+            The number of nodes inspected in the annoy search, -1 for the default of annoy
+    Returns:
+        res: list of lists of dictionaries
+            For each query, its results ordered by descending score, like util.semantic_search: {'corpus_id': row, 'score': cosine similarity}
+    """
+    if ann_idx is not None:
+        return ann_semantic_search(q_embbs,ann_idx,top_k,search_k)
+    if device == "cpu":
+        if not isinstance(embedd,np.ndarray):
+            embedd = embedd.cpu().numpy()
+        return cpu_semantic_search(q_embbs,embedd,top_k,block_size)
+    if isinstance(embedd,np.ndarray):
+        embedd = get_device_embeddings(embedd,device)
+    import torch
+    from sentence_transformers import util
+    return util.semantic_search(torch.from_numpy(q_embbs).to(embedd.device),embedd,top_k=top_k)
+
+def search_queries(queries : list[str], bi_enc : "SentenceTransformer", n_res : int, batch_size : int = 32, device : str|None = None,
+                   block_size : int = SEARCH_BLOCK_SIZE, use_ann : bool = False, search_k : int = -1) -> list[tuple[np.ndarray,np.ndarray,np.ndarray]]:
+    """
+    Searches many queries in all folders: the queries are encoded in batches with a single call to the model and each folder is searched
+    once for all of them, then the results of every folder are merged for each query
+
+    Parameters:
+        queries: list of strings
+            The queries to be searched
+        bi_enc: SentenceTransformer object
+            The loaded bi-encoder model
+        n_res: integer
+            The number of results to return for each query
+        batch_size: integer
+            The number of queries encoded at once by the model
+        device: string | None
+            The device in which the search is done (cuda or cpu), None to use cuda if it is available
+        block_size: integer
+            The number of embeddings compared at once when searching on CPU
+        use_ann: bool
+            If the annoy indexes over the embeddings are to be used instead of the exhaustive search
+        search_k: integer
+            The number of nodes inspected in the annoy search, -1 for the default of annoy
+    Returns:
+        results: list of tuples of numpy arrays
+            For each query, the files, scores and sentences of its results ordered by descending score, like search_query_in_all_folders
+    """
+    if device is None:
+        device = get_device()
+    q_embbs = np.asarray(bi_enc.encode(queries,batch_size=batch_size,convert_to_numpy=True),dtype=np.float32)
+    # Score, file and sentence of the results of each query in all folders
+    candidates = [[] for _ in queries]
+    for folder in tqdm(get_folders()):
+        folder_data = get_folder_files_content_embedds(folder)
+        ann_idx = get_folder_ann_index(folder) if use_ann else None
+        res = semantic_search_embeddings(q_embbs,folder_data["embedds"],n_res,device,block_size,ann_idx,search_k)
+        for q_candidates,q_res in zip(candidates,res):
+            q_candidates += [(r['score'],folder_data["files"][r['corpus_id']],folder_data["sentences"][r['corpus_id']]) for r in q_res]
+    results = []
+    for q_candidates in candidates:
+        best = heapq.nlargest(n_res,q_candidates,key=lambda candidate: candidate[0])
+        results.append((np.asarray([file for _,file,_ in best]),np.asarray([score for score,_,_ in best]),np.asarray([sentence for _,_,sentence in best])))
+    return results
\ No newline at end of file
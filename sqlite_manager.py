@@ -1,4 +1,5 @@
 import sqlite3 as sql
+import itertools
 import time as t
 
 def connect_db(db_name):
@@ -54,6 +55,15 @@ def folder_exists(conn,folder):
     exists = cursor.execute("SELECT folder_name FROM folders WHERE folder_name=?",(folder,))
     return True if exists.fetchone() is not None else False
 
+def drop_index(conn):
+    """
+    This function drops the unique index of the repetitions table, so big loads don't have to keep it updated row by row
+    The index has to be added again with add_index once all the data has been inserted
+    """
+    if not is_normalized_db(conn):
+        conn.cursor().execute("DROP INDEX IF EXISTS words_repetitions_index")
+        conn.commit()
+
 def add_index(conn):
     """
     This function adds a unique index to the repetitions table after all data has been inserted
@@ -63,6 +73,9 @@ def add_index(conn):
             A connection to the DB
     """
     cursor = conn.cursor()
+    if is_normalized_db(conn):
+        print("Normalized DB, indexes already exist")
+        return
     exists = cursor.execute("SELECT * FROM sqlite_master WHERE type= 'index' AND tbl_name = 'words_repetitions' and name = 'words_repetitions_index'")
     if exists.fetchone() is None:
         print("Adding index...")
@@ -74,48 +87,475 @@ def add_index(conn):
     else:
         print("Index already exists")
 
+def is_normalized_db(conn):
+    """
+    This function checks if the DB has the normalized schema, where words_repetitions is a view over integer-keyed tables
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+    """
+    cursor = conn.cursor()
+    exists = cursor.execute("SELECT name FROM sqlite_master WHERE type='view' AND name='words_repetitions'")
+    return True if exists.fetchone() is not None else False
+
+def migrate_to_normalized_db(src_db_name,dst_db_name):
+    """
+    This function copies a DB with the flat words_repetitions table to a new DB with a normalized schema
+    The new DB has the following tables:
+       · words(word_id, word) -> the indexed words
+       · files(file_id, file, file_year) -> the indexed files with their year
+       · bboxes(bbox_id, page, bbox) -> the different page and bounding box pairs
+       · word_occurrences(word_id, file_id, file_year, bbox_id, n_reps) -> the repetitions, clustered by word so word lookups read (file_year, n_reps) without touching other pages
+    And words_repetitions becomes a view with the same columns as the old table, with triggers for inserting and deleting,
+    so the rest of the functions of this file work the same on both schemas
+    The folders, indexed_files and documents tables are copied as they are, if they exist
+
+    Parameters:
+        src_db_name: string
+            The path to the DB with the flat table
+        dst_db_name: string
+            The path where the normalized DB is going to be created
+    """
+    tI = t.time()
+    conn = connect_db(dst_db_name)
+    cursor = conn.cursor()
+    cursor.execute("ATTACH DATABASE ? AS src",(src_db_name,))
+    cursor.execute("CREATE TABLE words(word_id INTEGER PRIMARY KEY, word TEXT UNIQUE)")
+    cursor.execute("CREATE TABLE files(file_id INTEGER PRIMARY KEY, file TEXT UNIQUE, file_year INTEGER)")
+    cursor.execute("CREATE TABLE bboxes(bbox_id INTEGER PRIMARY KEY, page TEXT, bbox TEXT, UNIQUE(page,bbox))")
+    cursor.execute("CREATE TABLE word_occurrences(word_id INTEGER, file_id INTEGER, file_year INTEGER, bbox_id INTEGER, n_reps INTEGER, PRIMARY KEY(word_id,file_id,bbox_id)) WITHOUT ROWID")
+    cursor.execute("CREATE TABLE folders(folder_name TEXT)")
+
+    print("Interning words, files and bounding boxes...")
+    cursor.execute("INSERT INTO words(word) SELECT DISTINCT word FROM src.words_repetitions")
+    cursor.execute("INSERT INTO files(file,file_year) SELECT file,MAX(file_year) FROM src.words_repetitions GROUP BY file")
+    cursor.execute("INSERT INTO bboxes(page,bbox) SELECT DISTINCT page,bbox FROM src.words_repetitions")
+    print("Copying repetitions...")
+    # The repetitions of duplicated rows are added, as they are the same word in the same section
+    cursor.execute("""
+    INSERT INTO word_occurrences
+    SELECT w.word_id, f.file_id, wr.file_year, b.bbox_id, wr.n_reps
+    FROM src.words_repetitions wr
+    INNER JOIN words w ON w.word = wr.word
+    INNER JOIN files f ON f.file = wr.file
+    INNER JOIN bboxes b ON b.page = wr.page AND b.bbox = wr.bbox
+    WHERE true
+    ON CONFLICT(word_id,file_id,bbox_id) DO UPDATE SET n_reps = n_reps + excluded.n_reps
+    """)
+    cursor.execute("INSERT INTO folders SELECT folder_name FROM src.folders")
+    if cursor.execute("SELECT name FROM src.sqlite_master WHERE name='indexed_files'").fetchone() is not None:
+        cursor.execute("CREATE TABLE indexed_files(file TEXT PRIMARY KEY, folder TEXT, mtime REAL, hash TEXT)")
+        cursor.execute("INSERT INTO indexed_files SELECT * FROM src.indexed_files")
+    if cursor.execute("SELECT name FROM src.sqlite_master WHERE name='documents'").fetchone() is not None:
+        create_documents_table(conn)
+        cursor.execute("INSERT INTO documents SELECT * FROM src.documents")
+    conn.commit()
+
+    print("Adding indexes...")
+    # word -> (file_year, n_reps) is served by the primary key, these cover the access by file and by year
+    cursor.execute("CREATE INDEX word_occurrences_file_index ON word_occurrences(file_id,word_id,bbox_id,n_reps)")
+    cursor.execute("CREATE INDEX word_occurrences_year_index ON word_occurrences(file_year,n_reps)")
+    cursor.execute("""
+    CREATE VIEW words_repetitions AS
+    SELECT w.word AS word, f.file AS file, o.file_year AS file_year, b.page AS page, b.bbox AS bbox, o.n_reps AS n_reps
+    FROM word_occurrences o
+    INNER JOIN words w ON w.word_id = o.word_id
+    INNER JOIN files f ON f.file_id = o.file_id
+    INNER JOIN bboxes b ON b.bbox_id = o.bbox_id
+    """)
+    cursor.execute("""
+    CREATE TRIGGER words_repetitions_insert INSTEAD OF INSERT ON words_repetitions
+    BEGIN
+        INSERT OR IGNORE INTO words(word) VALUES (NEW.word);
+        INSERT OR IGNORE INTO files(file,file_year) VALUES (NEW.file,NEW.file_year);
+        INSERT OR IGNORE INTO bboxes(page,bbox) VALUES (NEW.page,NEW.bbox);
+        INSERT INTO word_occurrences VALUES (
+            (SELECT word_id FROM words WHERE word = NEW.word),
+            (SELECT file_id FROM files WHERE file = NEW.file),
+            NEW.file_year,
+            (SELECT bbox_id FROM bboxes WHERE page = NEW.page AND bbox = NEW.bbox),
+            NEW.n_reps);
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER words_repetitions_delete INSTEAD OF DELETE ON words_repetitions
+    BEGIN
+        DELETE FROM word_occurrences
+        WHERE word_id = (SELECT word_id FROM words WHERE word = OLD.word)
+        AND file_id = (SELECT file_id FROM files WHERE file = OLD.file)
+        AND bbox_id = (SELECT bbox_id FROM bboxes WHERE page = OLD.page AND bbox = OLD.bbox);
+    END
+    """)
+    cursor.execute("ANALYZE")
+    conn.commit()
+    cursor.execute("DETACH DATABASE src")
+    conn.close()
+    print(f"DB normalized in {t.time()-tI}")
+
 def add_row(cur,word,file,year,page,bbox,reps):
     """
     This function adds a new row to the words table
     """
     cur.execute("INSERT INTO words_repetitions VALUES (?, ?, ?, ?, ?, ?)",(word,file,year,page,bbox,reps))
 
+def set_load_pragmas(conn,cache_size_mb=1024):
+    """
+    This function tunes the DB for loading big amounts of data, the journal is kept in memory and writes aren't synced
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+        cache_size_mb: integer
+            The size of the page cache in MB
+    Returns:
+        old_pragmas: dictionary
+            The values of the changed pragmas before tuning them, to restore them after loading
+    """
+    cursor = conn.cursor()
+    old_pragmas = {pragma: cursor.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in ["journal_mode","synchronous","cache_size","temp_store"]}
+    cursor.execute("PRAGMA journal_mode=MEMORY")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute(f"PRAGMA cache_size=-{cache_size_mb*1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    return old_pragmas
+
+def restore_pragmas(conn,old_pragmas):
+    """
+    This function restores the pragmas changed by set_load_pragmas
+    """
+    cursor = conn.cursor()
+    for pragma,value in old_pragmas.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+
+def bulk_add_rows(conn,rows,batch_size=100000,rebuild_index=True):
+    """
+    This function inserts a stream of rows in the words table, in big transactions and with the DB tuned for loading
+    The unique index is dropped before loading and added again at the end, as keeping it updated row by row is much slower
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+        rows: iterable of tuples
+            The (word,file,year,page,bbox,reps) rows to insert, can be a generator
+        batch_size: integer
+            The number of rows inserted in each transaction
+        rebuild_index: bool
+            If the index is to be dropped before loading and added after it
+    Returns:
+        n_rows: integer
+            The number of inserted rows
+    """
+    old_pragmas = set_load_pragmas(conn)
+    cursor = conn.cursor()
+    normalized = is_normalized_db(conn)
+    if rebuild_index and not normalized:
+        drop_index(conn)
+    tI = t.time()
+    n_rows = 0
+    rows = iter(rows)
+    try:
+        while True:
+            batch = list(itertools.islice(rows,batch_size))
+            if len(batch) == 0:
+                break
+            cursor.executemany("INSERT INTO words_repetitions VALUES (?, ?, ?, ?, ?, ?)",batch)
+            conn.commit()
+            n_rows += len(batch)
+            print(f"{n_rows} rows inserted, {n_rows/(t.time()-tI):0.0f} rows/s",end='\r')
+        print()
+        print(f"{n_rows} rows inserted in {t.time()-tI}, {n_rows/max(t.time()-tI,1e-9):0.0f} rows/s")
+        if rebuild_index and not normalized:
+            add_index(conn)
+    finally:
+        restore_pragmas(conn,old_pragmas)
+    return n_rows
+
 def add_folder(cur,folder):
     """
     This function adds a new row to the folders table
     """
     cur.execute("INSERT INTO folders VALUES (?)",(folder,))
 
+def create_indexed_files_table(conn):
+    """
+    This function creates the table that keeps track of the indexed files, used when adding files incrementally
+    The table has 4 attributes:
+       · The indexed file -> file
+       · The folder of the file -> folder
+       · The modification time of the file when it was indexed -> mtime
+       · The hash of the content of the file when it was indexed -> hash
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+    """
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS indexed_files(file TEXT PRIMARY KEY, folder TEXT, mtime REAL, hash TEXT)")
+    conn.commit()
+
+def get_indexed_files(cursor,folder):
+    """
+    This function returns the modification time and hash of each indexed file of a folder
+    """
+    cursor.execute("SELECT file,mtime,hash FROM indexed_files WHERE folder=?",(folder,))
+    return {row['file']: (row['mtime'],row['hash']) for row in cursor.fetchall()}
+
+def set_indexed_file(cur,file,folder,mtime,hash):
+    """
+    This function adds or updates the row of an indexed file
+    """
+    cur.execute("INSERT OR REPLACE INTO indexed_files VALUES (?, ?, ?, ?)",(file,folder,mtime,hash))
+
+def delete_file_rows(cur,file):
+    """
+    This function deletes all the rows of a file from the words table
+    """
+    cur.execute("DELETE FROM words_repetitions WHERE file=?",(file,))
+
+def delete_folder_rows(conn,folder):
+    """
+    This function deletes all the rows of the files of a folder from the words table and from the indexed files
+    """
+    cursor = conn.cursor()
+    folder_condition,params = get_folders_condition([folder],"file")
+    cursor.execute(f"DELETE FROM words_repetitions WHERE 1 {folder_condition}",params)
+    create_indexed_files_table(conn)
+    cursor.execute("DELETE FROM indexed_files WHERE folder=?",(folder,))
+    conn.commit()
+
+def get_folder_files(cursor,folder):
+    """
+    This function returns the files of a folder that have rows in the words table, it scans all the rows of the folder
+    """
+    folder_condition,params = get_folders_condition([folder])
+    cursor.execute(f"SELECT DISTINCT wr.file FROM words_repetitions wr WHERE 1 {folder_condition}",params)
+    return set(row[0] for row in cursor.fetchall())
+
+def create_documents_table(conn):
+    """
+    This function creates the table with the metadata of each document, so queries don't need to read the JSON files
+    The table has 7 attributes:
+       · The document, relative to the OCR DB -> file
+       · The folder of the document -> folder
+       · The year of the document -> file_year
+       · The link to the original document -> href
+       · The number of pages of the document -> n_pages
+       · The number of bounding boxes of the document -> n_bboxes
+       · The modification time of the file when its metadata was read -> mtime
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+    """
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS documents(file TEXT PRIMARY KEY, folder TEXT, file_year INTEGER, href TEXT, n_pages INTEGER, n_bboxes INTEGER, mtime REAL)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS documents_year_index ON documents(file_year)")
+    conn.commit()
+
+def documents_table_exists(conn):
+    """
+    This function checks if the table with the metadata of the documents exists
+    """
+    cursor = conn.cursor()
+    exists = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='documents'")
+    return True if exists.fetchone() is not None else False
+
+def get_documents_mtime(cursor):
+    """
+    This function returns the modification time of each document when its metadata was read
+    """
+    cursor.execute("SELECT file,mtime FROM documents")
+    return {row['file']: row['mtime'] for row in cursor.fetchall()}
+
+def add_documents(cur,rows):
+    """
+    This function adds or updates the metadata of a list of documents
+    """
+    cur.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",rows)
+
+def delete_documents(cur,files):
+    """
+    This function deletes the metadata of a list of documents
+    """
+    cur.executemany("DELETE FROM documents WHERE file=?",[(file,) for file in files])
+
+def get_documents_metadata(cursor,files_list):
+    """
+    Given a list of files, this function returns the metadata of each one
+    """
+    files_table = create_temp_table(cursor,"documents_list","file TEXT PRIMARY KEY",[(file,) for file in files_list])
+    try:
+        cursor.execute(f"SELECT * FROM documents WHERE file IN (SELECT file FROM {files_table})")
+        return {row['file']: row for row in cursor.fetchall()}
+    finally:
+        drop_temp_tables(cursor,files_table)
+
+def get_n_docs_per_year(cursor,folders=None):
+    """
+    This function returns the number of documents of each year, only of the documents of some folders if they are given
+    """
+    folders_condition,params = get_folders_condition(folders,"file")
+    cursor.execute(f"SELECT file_year,COUNT(*) AS n_docs FROM documents WHERE 1 {folders_condition} GROUP BY file_year ORDER BY file_year",params)
+    return {row['file_year']: row['n_docs'] for row in cursor.fetchall()}
+
+def get_files_years(cursor):
+    """
+    This function returns the year of each document
+    """
+    cursor.execute("SELECT file,file_year FROM documents")
+    return {row['file']: row['file_year'] for row in cursor.fetchall()}
+
 def query_word(cursor,word):
     """
     This function returns the instances where a word has been found
     """
     return cursor.execute("SELECT file,page,bbox,SUM(n_reps) AS total_words_reps FROM words_repetitions WHERE word=? GROUP BY file,page,bbox ORDER BY total_words_reps DESC",(word,))
 
+# Counter used to give a different name to each temporary table, the connection of the queries is shared by many threads
+TEMP_TABLES_COUNTER = itertools.count()
+
+def create_temp_table(cursor,name,columns,rows):
+    """
+    This function creates a temporary table with a name that no other call uses and fills it with the given rows
+
+    Parameters:
+        cursor: sqlite3 cursor object
+            A cursor of the DB
+        name: string
+            The beginning of the name of the table
+        columns: string
+            The definition of the columns of the table
+        rows: list of tuples
+            The rows of the table
+    Returns:
+        table: string
+            The name of the created table
+    """
+    table = f"{name}_temp_{next(TEMP_TABLES_COUNTER)}"
+    cursor.execute(f"CREATE TEMP TABLE {table} ({columns})")
+    cursor.executemany(f"INSERT OR IGNORE INTO {table} VALUES ({','.join(['?']*len(columns.split(',')))})",rows)
+    return table
+
+def drop_temp_tables(cursor,*tables):
+    """
+    This function drops temporary tables and ends the transaction opened when they were filled, so the DB isn't kept locked for writers
+    """
+    for table in tables:
+        cursor.execute(f"DROP TABLE IF EXISTS temp.{table}")
+    cursor.connection.commit()
+
+def create_query_words_table(cursor,words_list):
+    """
+    This function creates a temporary table with the words of a query, used to resolve all the words in one statement
+    The table must be dropped with drop_temp_tables once the query is done
+
+    Returns:
+        table: string
+            The name of the created table
+    """
+    return create_temp_table(cursor,"query_words","word TEXT PRIMARY KEY",[(word,) for word in words_list])
+
+def get_folders_condition(folders,column="wr.file"):
+    """
+    This function returns the condition (and its parameters) to keep only the rows of the files of some folders, the files are relative to the OCR DB
+    so each one starts with the name of its folder
+    """
+    if folders is None:
+        return "",[]
+    # The folder names can contain "_", which is a wildcard for LIKE, so it is escaped
+    patterns = [folder.replace("\\","\\\\").replace("%","\\%").replace("_","\\_")+"/%" for folder in folders]
+    if len(patterns) == 0:
+        return "AND 0",[]
+    return "AND ("+" OR ".join([f"{column} LIKE ? ESCAPE '\\'"]*len(patterns))+")",patterns
+
+def query_words(cursor,words_list,folders=None):
+    """
+    This function returns the instances where any of the words of a list has been found, resolving all the words in one statement
+
+    Parameters:
+        cursor: sqlite3 cursor object
+            A cursor of the DB
+        words_list: list of strings
+            The words to be found
+        folders: list of strings | None
+            The folders in which to find the words, None to find them in all the folders
+    Returns:
+        columns: dictionary
+            A dictionary with a list for each column (file, page, bbox and total_words_reps), the repetitions of all the words are added for each section
+    """
+    words_table = create_query_words_table(cursor,words_list)
+    folders_condition,params = get_folders_condition(folders)
+    query = f"""
+    SELECT wr.file, wr.page, wr.bbox, SUM(wr.n_reps) AS total_words_reps
+    FROM words_repetitions wr
+    WHERE wr.word IN (SELECT word FROM {words_table}) {folders_condition}
+    GROUP BY wr.file, wr.page, wr.bbox
+    ORDER BY total_words_reps DESC
+    """
+    try:
+        rows = cursor.execute(query,params).fetchall()
+    finally:
+        drop_temp_tables(cursor,words_table)
+    columns = {'file': [], 'page': [], 'bbox': [], 'total_words_reps': []}
+    if len(rows) > 0:
+        columns['file'],columns['page'],columns['bbox'],columns['total_words_reps'] = (list(column) for column in zip(*rows))
+    return columns
+
+def get_words_years_histogram(cursor,words_list,folders=None):
+    """
+    This function returns the number of times any of the words of a list has been found in each year
+
+    Parameters:
+        cursor: sqlite3 cursor object
+            A cursor of the DB
+        words_list: list of strings
+            The words to be found
+        folders: list of strings | None
+            The folders in which to find the words, None to find them in all the folders
+    Returns:
+        years: list of integers
+            The years in which the words have been found, in ascending order
+        reps: list of integers
+            The number of times the words have been found in each year
+    """
+    words_table = create_query_words_table(cursor,words_list)
+    folders_condition,params = get_folders_condition(folders)
+    query = f"""
+    SELECT wr.file_year, SUM(wr.n_reps) AS total_words_reps
+    FROM words_repetitions wr
+    WHERE wr.word IN (SELECT word FROM {words_table}) {folders_condition}
+    GROUP BY wr.file_year
+    ORDER BY wr.file_year
+    """
+    try:
+        rows = cursor.execute(query,params).fetchall()
+    finally:
+        drop_temp_tables(cursor,words_table)
+    return [row['file_year'] for row in rows],[row['total_words_reps'] for row in rows]
+
 def get_n_reps_from_files_list(cursor,files_list,words_list):
     """
     Given a list of files and a list of words, this function returns all the instances of files where the word appears
     """
-    cursor.execute(f"SELECT file,page,bbox,SUM(n_reps) AS total_words_reps FROM words_repetitions WHERE file IN ({','.join(['?' for _ in files_list])}) and word IN ({','.join(['?' for _ in words_list])}) GROUP BY file ORDER BY total_words_reps DESC",(*files_list,*words_list))
+    cursor.execute(f"SELECT file,file_year,page,bbox,SUM(n_reps) AS total_words_reps FROM words_repetitions WHERE file IN ({','.join(['?' for _ in files_list])}) and word IN ({','.join(['?' for _ in words_list])}) GROUP BY file ORDER BY total_words_reps DESC",(*files_list,*words_list))
     return cursor.fetchall()
 
 def get_n_reps_from_sections_list(cursor,sections_list,words_list):
     """
     Given a list of sections and a list of words, this function returns the instances of sections where the words have been found
     """
-    cursor.execute("DROP TABLE IF EXISTS temp.words_list_temp")
-    cursor.execute("DROP TABLE IF EXISTS temp.sections_list_temp")
-
-    cursor.execute("CREATE TEMP TABLE words_list_temp (word TEXT)")
-    cursor.execute("CREATE TEMP TABLE sections_list_temp (file TEXT, page TEXT, bbox TEXT)")
-    cursor.executemany("INSERT INTO words_list_temp (word) VALUES (?)", [(word,) for word in words_list])
-    cursor.executemany("INSERT INTO sections_list_temp (file, page, bbox) VALUES (?, ?, ?)", sections_list)
-    query = """
-    SELECT wr.file, wr.page, wr.bbox, SUM(wr.n_reps) AS total_words_reps
+    words_table = create_temp_table(cursor,"words_list","word TEXT",[(word,) for word in words_list])
+    sections_table = create_temp_table(cursor,"sections_list","file TEXT, page TEXT, bbox TEXT",sections_list)
+    query = f"""
+    SELECT wr.file, wr.file_year, wr.page, wr.bbox, SUM(wr.n_reps) AS total_words_reps
     FROM words_repetitions wr
-    INNER JOIN sections_list_temp sl ON wr.file = sl.file AND wr.page = sl.page AND wr.bbox = sl.bbox
-    WHERE wr.word IN (SELECT word FROM words_list_temp)
+    INNER JOIN {sections_table} sl ON wr.file = sl.file AND wr.page = sl.page AND wr.bbox = sl.bbox
+    WHERE wr.word IN (SELECT word FROM {words_table})
     GROUP BY wr.file, wr.page, wr.bbox
     """
-    cursor.execute(query)
-    return cursor.fetchall()
\ No newline at end of file
+    try:
+        cursor.execute(query)
+        return cursor.fetchall()
+    finally:
+        drop_temp_tables(cursor,words_table,sections_table)
\ No newline at end of file
@@ -1,9 +1,22 @@
 import json
+from collections import OrderedDict,Counter
+from multiprocessing import Pool
 from tqdm import tqdm
 import time as t
 from textdistance import damerau_levenshtein
+import sqlite_manager as s
+import phoc_annoy as ann
+import file_manager as fm
+from common import *
+import numpy as np
 import os
 
+# Number of different words of the text whose comparisons with the searched words are kept while searching in the files
+WORD_CACHE_SIZE = 50000
+
+# Number of bins of the character histograms of the word indexes, letters with and without accent share a bin
+N_HISTOGRAM_BINS = 64
+
 def get_filenames_from_folder(folder):
     file_list = []
     for item in os.listdir(folder):
@@ -15,21 +28,236 @@ def get_filenames_from_folder(folder):
     return file_list
 
 def get_text_from_JSON(filename):
-    file_dir = filename
-    with open(file_dir,"r") as opened:
-        file_text = opened.readline()
-        text_fixed = file_text.encode().decode("unicode_escape")
-        opened.close()
-        js_ld = json.loads(text_fixed)
-        full_text = ''
-        for elems in js_ld['pages']['0']:
-            full_text+= elems['ocr']
-        return full_text
+    # Searches go through all the files once, so the document cache is not used to keep it for the documents that are reused
+    js_ld = fm.read_document(filename)
+    full_text = ''
+    for elems in js_ld['pages']['0']:
+        full_text+= elems['ocr']
+    return full_text
     
-def search_words_in_spaced_text_from_files_WD(filenames,searched_words):
+def get_max_distance(word):
+    """
+    Returns the maximum Damerau-Levenshtein distance for a word to be considered the same as the searched word
+    """
+    return round(0.4*len(word))
+
+def bounded_damerau_levenshtein(s1,s2,max_dist):
+    """
+    Restricted Damerau-Levenshtein (optimal string alignment) distance between two strings, the same one textdistance uses by default,
+    the computation stops as soon as the distance is known to be greater than max_dist
+
+    Returns:
+        distance : integer
+            The distance between the strings, or max_dist+1 if it is greater than max_dist
+    """
+    if abs(len(s1)-len(s2)) > max_dist:
+        return max_dist+1
+    prev_prev = None
+    prev = list(range(len(s2)+1))
+    for i in range(1,len(s1)+1):
+        curr = [i] + [0]*len(s2)
+        for j in range(1,len(s2)+1):
+            cost = 0 if s1[i-1] == s2[j-1] else 1
+            curr[j] = min(prev[j]+1,curr[j-1]+1,prev[j-1]+cost)
+            if i > 1 and j > 1 and s1[i-1] == s2[j-2] and s1[i-2] == s2[j-1]:
+                curr[j] = min(curr[j],prev_prev[j-2]+1)
+        # The minimum of a row never decreases in the following ones
+        if min(curr) > max_dist:
+            return max_dist+1
+        prev_prev,prev = prev,curr
+    return prev[-1] if prev[-1] <= max_dist else max_dist+1
+
+def is_similar_word(searched_word,searched_hist,current_word,current_hist,max_dist):
+    """
+    Checks if a word is within max_dist Damerau-Levenshtein edits of the searched word, discarding most words with cheap lower bounds first
+
+    Parameters:
+        searched_word : string
+            The searched word
+        searched_hist : Counter
+            The number of times each character appears in the searched word
+        current_word : string
+            The word found in the text
+        current_hist : Counter
+            The number of times each character appears in the word found in the text
+        max_dist : integer
+            The maximum distance to consider both words the same
+    """
+    # Each edit changes the length in one character at most
+    if abs(len(current_word)-len(searched_word)) > max_dist:
+        return False
+    # Each edit changes the histogram of characters in two at most
+    hist_diff = sum(((searched_hist-current_hist)+(current_hist-searched_hist)).values())
+    if (hist_diff+1)//2 > max_dist:
+        return False
+    return bounded_damerau_levenshtein(searched_word,current_word,max_dist) <= max_dist
+
+def get_char_histogram(word):
+    """
+    Returns the number of times each character appears in a word, with the characters folded into N_HISTOGRAM_BINS bins
+
+    Two characters in the same bin only make the lower bound of the distance smaller, so it is still a lower bound
+    """
+    hist = np.zeros(N_HISTOGRAM_BINS,dtype=np.int16)
+    for char in word:
+        hist[ord(char)%N_HISTOGRAM_BINS] += 1
+    return hist
+
+def build_word_index(words):
+    """
+    Creates the index of a vocabulary used to search the words similar to a word without comparing it to all of them
+
+    Parameters:
+        words : list of strings
+            The words of the vocabulary
+    Returns:
+        index : dictionary
+            The words sorted by length, their lengths and the histogram of the characters of each word
+    """
+    words = sorted(dict.fromkeys(words),key=len)
+    histograms = np.zeros((len(words),N_HISTOGRAM_BINS),dtype=np.uint8)
+    for i,word in enumerate(tqdm(words,'building word index')):
+        for char in word:
+            histograms[i,ord(char)%N_HISTOGRAM_BINS] += 1
+    return {'words': words, 'lengths': np.asarray([len(word) for word in words],dtype=np.int32), 'histograms': histograms}
+
+def search_word_index(index,searched_word,max_dist=None):
+    """
+    Searches the words of an index within max_dist restricted Damerau-Levenshtein edits of the searched word,
+    the same condition used when searching in the text of the files
+
+    Parameters:
+        index : dictionary
+            The index created with build_word_index
+        searched_word : string
+            The searched word
+        max_dist : integer | None
+            The maximum distance to consider a word the same, round(0.4*len(searched_word)) by default
+    Returns:
+        similar_words : list of strings
+            The words of the index similar to the searched word
+    """
+    if max_dist is None:
+        max_dist = get_max_distance(searched_word)
+    # Each edit changes the length in one character at most, the words are sorted by length
+    start,end = np.searchsorted(index['lengths'],[len(searched_word)-max_dist,len(searched_word)+max_dist+1])
+    # Each edit changes the histogram of characters in two at most, computed for all the words of the lengths at once
+    hist_diff = np.abs(index['histograms'][start:end].astype(np.int16)-get_char_histogram(searched_word)).sum(axis=1)
+    candidates = np.flatnonzero((hist_diff+1)//2 <= max_dist)+start
+    words = index['words']
+    return [words[i] for i in candidates if bounded_damerau_levenshtein(searched_word,words[i],max_dist) <= max_dist]
+
+def get_word_index_filenames(folder):
+    """
+    Returns the paths to the words and to the histograms of the word index of a folder
+    """
+    return f"{WORD_INDEXES_PATH}{folder}.json",f"{WORD_INDEXES_PATH}{folder}_histograms.npy"
+
+def build_folder_word_index(folder):
+    """
+    Creates and saves the word index of the vocabulary of a folder, taken from the words of its annoy index and of its delta index
+
+    Parameters:
+        folder : string
+            The name of the folder inside the OCR DB
+    Returns:
+        index : dictionary
+            The word index of the vocabulary of the folder
+    """
+    words = []
+    for words_filename in [f"{IDXS_2_WORDS_PATH}{folder}.json",ann.get_delta_filenames(folder)[1]]:
+        if os.path.exists(words_filename):
+            words += fm.load_json(words_filename)
+    index = build_word_index(words)
+    os.makedirs(WORD_INDEXES_PATH,exist_ok=True)
+    words_filename,histograms_filename = get_word_index_filenames(folder)
+    # Save to temporary files and replace the old ones, like the annoy indexes
+    fm.save_json(index['words'],words_filename+".tmp")
+    np.save(histograms_filename+".tmp.npy",index['histograms'])
+    os.replace(words_filename+".tmp",words_filename)
+    os.replace(histograms_filename+".tmp.npy",histograms_filename)
+    return index
+
+def load_folder_word_index(folder):
+    """
+    Loads the word index of the vocabulary of a folder, it is built again if the vocabulary or the delta index have changed since it was saved
+    """
+    words_filename,histograms_filename = get_word_index_filenames(folder)
+    vocabulary_filenames = [f"{IDXS_2_WORDS_PATH}{folder}.json",ann.get_delta_filenames(folder)[1]]
+    if not os.path.exists(histograms_filename) or any(os.path.exists(filename) and os.path.getmtime(filename) > os.path.getmtime(histograms_filename) for filename in vocabulary_filenames):
+        return build_folder_word_index(folder)
+    words = fm.load_json(words_filename)
+    return {'words': words, 'lengths': np.asarray([len(word) for word in words],dtype=np.int32), 'histograms': np.load(histograms_filename)}
+
+def search_words_in_vocabulary(indexes,searched_words):
+    """
+    Searches the words of the vocabularies similar to each searched word
+
+    Parameters:
+        indexes : list of dictionaries
+            The word indexes of the vocabularies in which to search
+        searched_words : list of strings
+            The words to be searched
+    Returns:
+        similar_words : dictionary
+            The similar words found in any vocabulary for each searched word
+    """
+    similar_words = {}
+    for searched_word in searched_words:
+        found = {}
+        for index in indexes:
+            for word in search_word_index(index,searched_word):
+                found[word] = None
+        similar_words[searched_word] = list(found.keys())
+    return similar_words
+
+def get_similar_words_occurrences(conn,indexes,searched_words):
+    """
+    Gets the sections where the words similar to each searched word appear, using the vocabularies instead of reading the files
+
+    Parameters:
+        conn: sqlite3 connection object
+            A connection to the DB
+        indexes : list of dictionaries
+            The word indexes of the vocabularies in which to search
+        searched_words : list of strings
+            The words to be searched
+    Returns:
+        occurrences : dictionary
+            For each searched word, the similar words found and the file, page, bbox and total_words_reps columns of their sections
+    """
+    similar_words = search_words_in_vocabulary(indexes,searched_words)
+    occurrences = {}
+    for searched_word,words in similar_words.items():
+        occurrences[searched_word] = {'words': words, 'sections': s.query_words(conn.cursor(),words)}
+    return occurrences
+
+def search_words_in_spaced_text_from_files_WD(filenames,searched_words,cache=None,show_progress=True):
+    """
+    Searches the words similar to each searched word in the text of each file, comparing each different word of the text once
+
+    Parameters:
+        filenames : list of strings
+            The paths to the JSON files in which to search
+        searched_words : list of strings
+            The words to be searched
+        cache : OrderedDict | None
+            The result of the comparisons already done for each word of the text, shared among files, only the WORD_CACHE_SIZE words used most recently are kept
+        show_progress : bool
+            If the progress bar is to be shown
+    Returns:
+        results : dictionary
+            For each file and searched word, the position and value of each similar word found in the text
+        exceptions : dictionary
+            The error found in each file that couldn't be read
+    """
     results = {}
     exceptions = {}
-    for file in tqdm(filenames):
+    if cache is None:
+        cache = OrderedDict()
+    searched_hists = [Counter(searched_word) for searched_word in searched_words]
+    max_dists = [get_max_distance(searched_word) for searched_word in searched_words]
+    for file in tqdm(filenames,disable=not show_progress):
         try:
             results[file] = {}
             for searched_word in searched_words:
@@ -40,42 +268,128 @@ def search_words_in_spaced_text_from_files_WD(filenames,searched_words):
             #print(f'time to get the text: {(t.time_ns() - tt)*(10**-6)} ms')
             #print(text)
             #tw = t.time_ns()
-            for i in range(len(text.split())):#tqdm(range(len(text.split())),desc=f'Finding similar words to {word}'):#
-                current_word = text.split()[i]
-                for searched_word in searched_words:
-                    #print(f"Searching similar words to {word}...")
-                    if len(current_word)+round(0.4*len(searched_word)) < len(searched_word):
-                        continue
-                    if (damerau_levenshtein(searched_word,current_word) <= round(0.4*len(searched_word))):# or (searched_word == current_word):
-                        results[file][searched_word].append([i,current_word])
+            split_text = text.split()
+            # Get the searched words similar to each different word of the text
+            similar_to = {}
+            for current_word in set(split_text):
+                if current_word in cache:
+                    cache.move_to_end(current_word)
+                else:
+                    cache[current_word] = {}
+                compared = cache[current_word]
+                current_hist = None
+                similar_to[current_word] = []
+                for searched_word,searched_hist,max_dist in zip(searched_words,searched_hists,max_dists):
+                    if searched_word not in compared:
+                        if current_hist is None:
+                            current_hist = Counter(current_word)
+                        compared[searched_word] = is_similar_word(searched_word,searched_hist,current_word,current_hist,max_dist)
+                    if compared[searched_word]:
+                        similar_to[current_word].append(searched_word)
+            while len(cache) > WORD_CACHE_SIZE:
+                cache.popitem(last=False)
+            for i,current_word in enumerate(split_text):
+                for searched_word in similar_to[current_word]:
+                    results[file][searched_word].append([i,current_word])
             #print(f'time to find all searched words in the text: {(t.time_ns() - tw)*(10**-6)} ms')
         except Exception as e:
             exceptions[file] = str(e)
     return results,exceptions
     
-def search_words_in_text_from_files_WD(filenames,searched_words):
-    for file in filenames:
-        #print(f'Searching in {file}...\n')
-        text = get_text_from_JSON(file)
-        text = ''.join(text.split())
-        #print(text)
-        th_res = {}
-        words_dic = {}
-        for word in searched_words:
-            sim_list = []
-            #print(f"Searching similar words to {word}...")
-            for i in range(len(text)):#tqdm(range(len(text)),desc=f'Finding similar words to {word}'):
-                if text[i:(i+len(word))].lower() == word.lower():
-                    sim_list.append([i,text[i:(i+len(word))],'already matching word'])
-                elif damerau_levenshtein(word,text[i:(i+len(word))]) <= round(0.4*len(word)):
-                    sim_list.append([i,text[i:(i+len(word))]])
-            sim_list = group_found(sim_list)
-            words_dic[word] = sim_list
-        th_res['word-distance'] = words_dic
-        #printThRes(th_res,text)
-        return th_res
+def approximate_substring_matches(text,word,max_dist):
+    """
+    Finds the substrings of the text within max_dist restricted Damerau-Levenshtein edits of the word in a single pass over the text
+    (Sellers' algorithm with transpositions), only the rows of the dynamic programming matrix that can still match are computed (Ukkonen's cut-off)
+
+    Parameters:
+        text : string
+            The text in which to search
+        word : string
+            The searched word
+        max_dist : integer
+            The maximum distance to consider a substring the same as the word
+    Returns:
+        matches : list of lists
+            The start position and value of each matching substring, one for each position of the text where a match ends,
+            with 'already matching word' added when the substring is the word ignoring the case
+    """
+    m = len(word)
+    over = max_dist+1
+    # Distance and start position of the best alignment of each prefix of the word ending at the current position of the text
+    prev = [min(i,over) for i in range(m+1)]
+    prev_start = [0]*(m+1)
+    prev_prev = prev_prev_start = None
+    # Last row of the column whose distance is not over max_dist
+    last_active = min(max_dist,m)
+    matches = []
+    lower_word = word.lower()
+    for j in range(1,len(text)+1):
+        char = text[j-1]
+        curr = [0] + [over]*m
+        curr_start = [j] + [j]*m
+        for i in range(1,min(last_active+1,m)+1):
+            best = prev[i-1] + (0 if word[i-1] == char else 1)
+            best_start = prev_start[i-1]
+            if prev[i]+1 < best:
+                best = prev[i]+1
+                best_start = prev_start[i]
+            if curr[i-1]+1 < best:
+                best = curr[i-1]+1
+                best_start = curr_start[i-1]
+            if i > 1 and j > 1 and word[i-1] == text[j-2] and word[i-2] == char and prev_prev[i-2]+1 < best:
+                best = prev_prev[i-2]+1
+                best_start = prev_prev_start[i-2]
+            curr[i] = min(best,over)
+            curr_start[i] = best_start
+        last_active = m
+        while curr[last_active] > max_dist:
+            last_active -= 1
+        if curr[m] <= max_dist:
+            start = curr_start[m]
+            if text[start:j].lower() == lower_word:
+                matches.append([start,text[start:j],'already matching word'])
+            else:
+                matches.append([start,text[start:j]])
+        prev_prev,prev_prev_start = prev,prev_start
+        prev,prev_start = curr,curr_start
+    return matches
+
+def search_words_in_text_from_files_WD(filenames,searched_words,show_progress=True):
+    """
+    Searches the words in the text of each file with the spaces removed, so words split by spurious spaces in the OCR are found
+
+    Parameters:
+        filenames : list of strings
+            The paths to the JSON files in which to search
+        searched_words : list of strings
+            The words to be searched
+        show_progress : bool
+            If the progress bar is to be shown
+    Returns:
+        results : dictionary
+            For each file and searched word, the groups of matches found close to each other in the text
+        exceptions : dictionary
+            The error found in each file that couldn't be read
+    """
+    results = {}
+    exceptions = {}
+    for file in tqdm(filenames,disable=not show_progress):
+        try:
+            #print(f'Searching in {file}...\n')
+            text = get_text_from_JSON(file)
+            text = ''.join(text.split())
+            #print(text)
+            words_dic = {}
+            for word in searched_words:
+                #print(f"Searching similar words to {word}...")
+                sim_list = approximate_substring_matches(text,word,get_max_distance(word))
+                words_dic[word] = group_found(sim_list)
+            results[file] = words_dic
+        except Exception as e:
+            exceptions[file] = str(e)
+    return results,exceptions
     
-def search_words_in_text_from_files(filenames,searched_words,text_mode,selection_mode):
+def search_words_in_text_from_files(filenames,searched_words,text_mode,selection_mode,n_workers=1,files_per_chunk=100):
     if text_mode not in ["sep","join"]:
         print(f"Error, text mode {text_mode} not available")
         return -1
@@ -83,25 +397,97 @@ def search_words_in_text_from_files(filenames,searched_words,text_mode,selection
         print(f"Error, selection mode {selection_mode} not available")
         return -1
     
+    if n_workers > 1:
+        return search_words_in_text_from_files_parallel(filenames,searched_words,text_mode,selection_mode,n_workers,files_per_chunk)
+
     if selection_mode == "word-distance":
         if text_mode == "sep":
             return search_words_in_spaced_text_from_files_WD(filenames,searched_words)
         else:
             return search_words_in_text_from_files_WD(filenames,searched_words)
 
+# Comparisons done by the current process, kept among the chunks of files it searches
+WORKER_CACHE = OrderedDict()
+
+def search_files_chunk(args):
+    """
+    Searches the words in a chunk of files, used by each worker when searching in parallel
+
+    Parameters:
+        args : tuple
+            The files of the chunk, the searched words, the text mode and the selection mode
+    Returns:
+        results : dictionary
+            For each file and searched word, the similar words found in the text
+        exceptions : dictionary
+            The error found in each file that couldn't be read
+        pid : integer
+            The id of the worker process
+        time : float
+            The time the worker needed to search in the chunk
+    """
+    filenames,searched_words,text_mode,selection_mode = args
+    tI = t.time()
+    if selection_mode == "word-distance":
+        if text_mode == "sep":
+            results,exceptions = search_words_in_spaced_text_from_files_WD(filenames,searched_words,WORKER_CACHE,False)
+        else:
+            results,exceptions = search_words_in_text_from_files_WD(filenames,searched_words,False)
+    return results,exceptions,os.getpid(),t.time()-tI
+
+def search_words_in_text_from_files_parallel(filenames,searched_words,text_mode,selection_mode,n_workers,files_per_chunk=100):
+    """
+    Searches the words in the files with a pool of processes, each worker searches in a chunk of files at a time
+
+    Parameters:
+        filenames : list of strings
+            The paths to the JSON files in which to search
+        searched_words : list of strings
+            The words to be searched
+        text_mode : string
+            How the text of the files is treated, "sep" or "join"
+        selection_mode : string
+            How the similar words are selected, "word-distance"
+        n_workers : integer
+            The number of processes searching in the files
+        files_per_chunk : integer
+            The number of files searched by a worker at a time
+    Returns:
+        results : dictionary
+            For each file and searched word, the similar words found in the text, in the same order as filenames
+        exceptions : dictionary
+            The error found in each file that couldn't be read, in the same order as filenames
+    """
+    chunks = [(filenames[i:i+files_per_chunk],searched_words,text_mode,selection_mode) for i in range(0,len(filenames),files_per_chunk)]
+    results = {}
+    exceptions = {}
+    workers_time = {}
+    with Pool(n_workers) as pool:
+        # imap returns the chunks in order, so the results are merged in the same order as the files
+        for chunk_results,chunk_exceptions,pid,time in tqdm(pool.imap(search_files_chunk,chunks),'chunks',total=len(chunks)):
+            results.update(chunk_results)
+            exceptions.update(chunk_exceptions)
+            workers_time[pid] = workers_time.get(pid,0) + time
+    for pid,time in workers_time.items():
+        print(f'Worker {pid}: {time:0.2f} seconds')
+    return results,exceptions
+
 def group_found(sim_list):
+    """
+    Groups the matches found close to each other in a single sweep, a match joins the last group if it starts within its length of the last member
+
+    Parameters:
+        sim_list : list of lists
+            The matches, each one starting with its position and value
+    Returns:
+        groups : list of lists of lists
+            The groups of matches, in order of position
+    """
     groups = []
-    for instance in sim_list:
-        found_group = False
-        for group in groups:
-            for member in group:
-                if abs(member[0] - instance[0]) <= len(instance[1]):
-                    group.append(instance)
-                    found_group = True
-                    break
-                if found_group:
-                    break
-        if not found_group:
+    for instance in sorted(sim_list,key=lambda x: x[0]):
+        if len(groups) > 0 and abs(groups[-1][-1][0] - instance[0]) <= len(instance[1]):
+            groups[-1].append(instance)
+        else:
             groups.append([instance])
     return groups
 
@@ -119,31 +505,32 @@ def get_context(split_text,position,mode="join"):
         pass
 
 
-filenames = ["BD/0a209a77-36e1-4d9e-9cb4-887db792e498_gt.json", "BD/0cca4935-2087-4f9d-91e4-f7bd6bfdfb7a_gt.json", "BD/0e7ced47-8f19-431e-a2cb-41e2b0853836_gt.json"]
-searched_words = ["Rey","Asturias","Consejo","guerra","invasion","hijo","sanidad","salud","peste","acaecimiento","América"]
+if __name__ == "__main__":
+    filenames = ["BD/0a209a77-36e1-4d9e-9cb4-887db792e498_gt.json", "BD/0cca4935-2087-4f9d-91e4-f7bd6bfdfb7a_gt.json", "BD/0e7ced47-8f19-431e-a2cb-41e2b0853836_gt.json"]
+    searched_words = ["Rey","Asturias","Consejo","guerra","invasion","hijo","sanidad","salud","peste","acaecimiento","América"]
 
-folder = "BD/BOEv2/alfonso_xii/alfonso_xii/jsons"
-colera_filenames = get_filenames_from_folder(folder)
-colera_words = ["Agua","hídrico","Cordón","Invasión","Epidemia","Higiene"]
+    folder = "BD/BOEv2/alfonso_xii/alfonso_xii/jsons"
+    colera_filenames = get_filenames_from_folder(folder)
+    colera_words = ["Agua","hídrico","Cordón","Invasión","Epidemia","Higiene"]
 
-wh = '_'.join([w for w in colera_words])
-fh = folder.replace('BD/BOEv2/','').replace('/','_')
+    wh = '_'.join([w for w in colera_words])
+    fh = folder.replace('BD/BOEv2/','').replace('/','_')
 
-res_file = f'res_file_q_{fh}_{wh}.json'
-exc_file = f'exc_file_q_{fh}_{wh}.json'
+    res_file = f'res_file_q_{fh}_{wh}.json'
+    exc_file = f'exc_file_q_{fh}_{wh}.json'
 
-text_mode = "sep"
-sel_mode = "word-distance"
+    text_mode = "sep"
+    sel_mode = "word-distance"
 
-it = t.time()
-re,exc = search_words_in_text_from_files(colera_filenames,colera_words,text_mode,sel_mode)
-ft = t.time() - it
-print(f'Using {text_mode} and {sel_mode}: {ft:0.2f} seconds')
-#print(f'Using {text_mode} and {sel_mode}: {ft/3600:0.2f} hours')
-#print(json.dumps(re,indent=4))
+    it = t.time()
+    re,exc = search_words_in_text_from_files(colera_filenames,colera_words,text_mode,sel_mode)
+    ft = t.time() - it
+    print(f'Using {text_mode} and {sel_mode}: {ft:0.2f} seconds')
+    #print(f'Using {text_mode} and {sel_mode}: {ft/3600:0.2f} hours')
+    #print(json.dumps(re,indent=4))
 
-#json.dump(re,open(res_file,"w"))
-json.dump(exc,open(exc_file,"w"))
+    #json.dump(re,open(res_file,"w"))
+    json.dump(exc,open(exc_file,"w"))
 
 """
 result structure: